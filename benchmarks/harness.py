@@ -0,0 +1,97 @@
+"""Measurement and reporting helpers shared by the benchmarks
+
+Every benchmark reports one result dict built by summarize(): items
+per second, p50/p99 latency of a single item and peak RSS of the
+benchmark process and its children, printed as JSON so runs can be
+compared, see run_all.py.
+"""
+import json
+import math
+import resource
+import sys
+import time
+
+
+def percentile(values, q):
+    """Returns the q-th percentile (0-100) of values, nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process and of its
+    largest waited-for child in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+                 1)
+
+
+class Latencies:
+    """Collects the latency of single items of a benchmark run
+
+    Use time() as a context manager around one item, or add() a
+    latency measured elsewhere. Thread safe for appends.
+    """
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+
+    def __init__(self, latencies):
+        self.latencies = latencies
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.latencies.add(time.perf_counter() - self.start)
+
+
+def summarize(name, items, seconds, latencies, unit='items', **params):
+    """Returns the result of a benchmark run
+
+    Args:
+        name (string): Benchmark name, <tool>.<path>
+        items (int): Items processed
+        seconds (float): Wall time of the run
+        latencies (list): Seconds per item
+        unit (string, optional): What an item is. Defaults to 'items'.
+        **params: Benchmark parameters and extra measurements
+
+    Returns:
+        dict: name, items, unit, seconds, throughput (items/s),
+            p50_ms, p99_ms, peak_rss_mb and params
+    """
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'name': name,
+        'items': items,
+        'unit': unit,
+        'seconds': round(seconds, 3),
+        'throughput': round(items / seconds, 2) if seconds > 0 else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'peak_rss_mb': peak_rss_mb(),
+        'params': params
+    }
+
+
+def emit(result):
+    """Print a result as JSON on stdout, see run_all.py"""
+    print(json.dumps(result, indent=2))
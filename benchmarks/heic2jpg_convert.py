@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark heic2jpg conversions
+
+Generates HEIC fixtures in a temporary directory (one encoded image,
+copied) and converts them with the worker pool of heic2jpg. Peak RSS
+includes the worker processes. Run it from the heic2jpg virtual
+environment:
+
+    cd heic2jpg && pipenv run python ../benchmarks/heic2jpg_convert.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'heic2jpg'))
+import main as heic2jpg  # noqa: E402
+from harness import emit, summarize  # noqa: E402
+
+
+def write_heic(path, width, height):
+    """Write a HEIC photo stand-in: a fractal with colour gradients
+    and EXIF, so it does not compress to nothing"""
+    import pillow_heif
+    from PIL import Image
+    size = (width, height)
+    img = Image.merge('RGB', (
+        Image.effect_mandelbrot(size, (-2, -1.25, 0.75, 1.25), 64),
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').resize(size)))
+    exif = Image.Exif()
+    # Orientation and camera model
+    exif[0x0112] = 1
+    exif[0x0110] = 'heic2jpg benchmark'
+    pillow_heif.from_pillow(img).save(path, quality=80, exif=exif.tobytes())
+
+
+@click.command()
+@click.option('--images', default=24, help='HEIC files to convert')
+@click.option('--width', default=4032, help='Image width')
+@click.option('--height', default=3024, help='Image height')
+@click.option('--workers', type=int, help='Worker processes, defaults to '
+              'CPU count')
+@click.option('--quality', default=92, help='JPEG quality')
+@click.option('--memory', default=1024, help='Memory budget in MB')
+def main(images, width, height, workers, quality, memory):
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source.heic')
+        write_heic(source, width, height)
+        for i in range(images):
+            shutil.copyfile(source, os.path.join(tmp, f'IMG_{i:04d}.HEIC'))
+        os.remove(source)
+        heic_files = heic2jpg.scan(tmp)
+        heic_mb = sum(s.st_size for s in heic_files.values()) / 1024 / 1024
+        start = time.perf_counter()
+        stats = heic2jpg.convert_heic_to_jpg(heic_files, {}, workers,
+                                             quality, memory * 1024 * 1024)
+        seconds = time.perf_counter() - start
+    emit(summarize('heic2jpg.convert', stats['converted'], seconds,
+                   stats['durations'], unit='images',
+                   megapixels=round(width * height / 1e6, 1),
+                   workers=workers or os.cpu_count(), quality=quality,
+                   memory_mb=memory, heic_mb=round(heic_mb, 1),
+                   megapixels_per_s=round(stats['converted'] * width
+                                          * height / 1e6 / seconds, 1)))
+
+
+if __name__ == '__main__':
+    main()
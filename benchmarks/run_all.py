@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Run all benchmarks and save their results as one JSON file
+
+Every benchmark runs in its own process, from the directory of the
+tool it measures, so peak RSS is per benchmark. A run can be compared
+with an earlier one:
+
+    python run_all.py --output after.json --compare before.json
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import click
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+# Benchmark script and the tool directory it runs from
+SUITE = {
+    'web_monitor_probe': 'web-monitor',
+    'web_monitor_producer': 'web-monitor',
+    'web_monitor_consumer': 'web-monitor',
+    'web_backup_parse': 'web-backup',
+    'web_backup_crawl': 'web-backup',
+    'youtube_videos_download': 'youtube-videos',
+    'heic2jpg_convert': 'heic2jpg',
+    'startup': 'benchmarks',
+}
+
+
+def run(name, python):
+    """Returns the JSON result of one benchmark, None if it failed"""
+    script = os.path.join(BENCHMARKS, f'{name}.py')
+    proc = subprocess.run([python, script, *(['--python', python]
+                                             if name == 'startup' else [])],
+                          cwd=os.path.join(ROOT, SUITE[name]),
+                          capture_output=True, text=True)
+    if proc.returncode:
+        print(f'{name} failed:\n{proc.stderr}', file=sys.stderr)
+        return None
+    return json.loads(proc.stdout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    """Print throughput and latency of every benchmark in both runs,
+    as after/before ratios"""
+    old = {r['name']: r for r in before['results']}
+    for result in after['results']:
+        previous = old.get(result['name'])
+        if not previous:
+            continue
+        line = [result['name']]
+        # Start time benchmarks have no throughput
+        for key in ('throughput', 'p50_ms', 'p99_ms', 'peak_rss_mb'):
+            if result.get(key) and previous.get(key):
+                line.append(f'{key} {previous[key]} -> {result[key]} '
+                            f'({result[key] / previous[key]:.2f}x)')
+        print('  '.join(line))
+
+
+@click.command()
+@click.option('--only', multiple=True, type=click.Choice(list(SUITE)),
+              help='Run only these benchmarks')
+@click.option('--python', default=sys.executable,
+              help='Python interpreter with the tools installed')
+@click.option('--output', help='Results JSON file')
+@click.option('--compare', 'baseline', type=click.File(),
+              help='Earlier results JSON file to compare with')
+def main(only, python, output, baseline):
+    results = []
+    for name in only or SUITE:
+        print(f'Running {name}', file=sys.stderr)
+        result = run(name, python)
+        if result is None:
+            continue
+        # Benchmarks comparing variants report one result per variant
+        if isinstance(result, list):
+            results += result
+        else:
+            results.append(result)
+    run_result = {
+        'timestamp': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(run_result, f, indent=2)
+    else:
+        print(json.dumps(run_result, indent=2))
+    if baseline:
+        compare(json.load(baseline), run_result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+"""Local stand-ins for external services used by the benchmarks"""
+import collections
+import http.server
+import io
+import re
+import socketserver
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Produce up to v3 (message format v2), Metadata up to v4: kafka-python
+# identifies the stand-in as a Kafka 0.11 broker
+BROKER_API_VERSIONS = [(18, 0, 1), (3, 0, 4), (0, 0, 3)]
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def _record_count(records):
+    """Number of records in message format v2 record batches"""
+    count = 0
+    offset = 0
+    while offset + 61 <= len(records):
+        length, = struct.unpack_from('!i', records, offset + 8)
+        count += struct.unpack_from('!i', records, offset + 57)[0]
+        offset += 12 + length
+    return count
+
+
+class _KafkaHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            header = _recv_exactly(self.request, 4)
+            if header is None:
+                return
+            frame = _recv_exactly(self.request, struct.unpack('!i', header)[0])
+            if frame is None:
+                return
+            response = self.server.respond(frame)
+            if response is not None:
+                self.request.sendall(struct.pack('!i', len(response))
+                                     + response)
+
+
+class StandInKafkaBroker(socketserver.ThreadingTCPServer):
+    """Single node Kafka broker speaking the wire protocol that
+    kafka.KafkaProducer needs: ApiVersions, Metadata and Produce
+
+    Every topic exists with one partition. Produce requests are
+    acknowledged after rtt seconds, records are counted and dropped.
+    Requests are decoded and responses encoded with kafka-python's
+    protocol classes.
+
+    Args:
+        rtt (float): Injected round-trip time of a produce request in
+            seconds
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rtt=0.005):
+        super().__init__(('127.0.0.1', 0), _KafkaHandler)
+        self.rtt = rtt
+        self.requests = 0
+        self.records = 0
+        self.bytes = 0
+        self._offsets = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+
+    @property
+    def bootstrap_servers(self):
+        return '%s:%d' % self.server_address
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def respond(self, frame):
+        """Returns the encoded response to a request frame, None if the
+        request needs no response"""
+        from kafka.protocol.admin import ApiVersionResponse
+        from kafka.protocol.metadata import MetadataRequest
+        from kafka.protocol.produce import ProduceRequest
+
+        data = io.BytesIO(frame)
+        api_key, version, correlation_id, client_id = struct.unpack(
+            '!hhih', data.read(10))
+        data.read(max(client_id, 0))
+        if api_key == ApiVersionResponse[0].API_KEY:
+            fields = {'error_code': 0, 'api_versions': BROKER_API_VERSIONS,
+                      'throttle_time_ms': 0}
+            response = ApiVersionResponse[version]
+        elif api_key == MetadataRequest[0].API_KEY:
+            request = MetadataRequest[version].decode(data)
+            fields = self._metadata(version, request.topics)
+            response = MetadataRequest[version].RESPONSE_TYPE
+        elif api_key == ProduceRequest[0].API_KEY:
+            request = ProduceRequest[version].decode(data)
+            fields = self._produce(version, request.topics, len(frame))
+            if not request.required_acks:
+                return None
+            response = ProduceRequest[version].RESPONSE_TYPE
+        else:
+            # Like Kafka, close the connection on unknown requests
+            raise ConnectionError(f'Unsupported API key {api_key}')
+        # encode() of a response only holds a weak reference to it
+        body = response(**{name: fields[name]
+                           for name in response.SCHEMA.names})
+        return struct.pack('!i', correlation_id) + body.encode()
+
+    def _metadata(self, version, topics):
+        host, port = self.server_address
+        if version == 0:
+            brokers = [(0, host, port)]
+            return {'brokers': brokers, 'topics': [
+                (0, topic, [(0, 0, 0, [0], [0])]) for topic in topics]}
+        return {
+            'throttle_time_ms': 0,
+            'brokers': [(0, host, port, None)],
+            'cluster_id': 'stand-in',
+            'controller_id': 0,
+            'topics': [(0, topic, False, [(0, 0, 0, [0], [0])])
+                       for topic in topics or []]
+        }
+
+    def _produce(self, version, topics, size):
+        time.sleep(self.rtt)
+        acknowledged = []
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            for topic, partitions in topics:
+                result = []
+                for partition, records in partitions:
+                    count = _record_count(records)
+                    base = self._offsets[topic, partition]
+                    self._offsets[topic, partition] += count
+                    self.records += count
+                    # log_append_time only since Produce v2
+                    fields = (partition, 0, base, -1)
+                    result.append(fields if version >= 2 else fields[:3])
+                acknowledged.append((topic, result))
+        return {'topics': acknowledged, 'throttle_time_ms': 0}
+
+
+class _FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this every
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.server.requests += 1
+        parts = urlsplit(self.path)
+        body = self.server.resolve(parts.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status = 200
+        # Byte ranges from a Range header or a YouTube style range
+        # query parameter
+        match = (re.search(r'(?:^|&)range=(\d+)-(\d+)', parts.query)
+                 or re.match(r'bytes=(\d+)-(\d+)',
+                             self.headers.get('Range', '')))
+        if match:
+            start, stop = int(match[1]), int(match[2])
+            body = memoryview(body)[start:stop + 1]
+            status = 206 if 'Range' in self.headers else 200
+        self.send_response(status)
+        self.send_header('Content-Type', self.server.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    """Keep-alive HTTP server for fixture content that answers every
+    request after latency seconds
+
+    Args:
+        routes (dict or callable): Response body (bytes) by path, or a
+            function returning the body of a path, None for 404
+        latency (float): Injected latency in seconds
+        content_type (string): Content-Type of all responses
+    """
+    daemon_threads = True
+    # Concurrent clients connect at once
+    request_queue_size = 1024
+
+    def __init__(self, routes, latency=0.0, content_type='text/html'):
+        super().__init__(('127.0.0.1', 0), _FixtureHandler)
+        self.routes = routes
+        self.latency = latency
+        self.content_type = content_type
+        self.requests = 0
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def resolve(self, path):
+        if callable(self.routes):
+            return self.routes(path)
+        return self.routes.get(path)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+ConsumerRecord = collections.namedtuple(
+    'ConsumerRecord', ['topic', 'partition', 'offset', 'value'])
+TopicPartition = collections.namedtuple('TopicPartition',
+                                        ['topic', 'partition'])
+
+
+class StandInConsumer:
+    """kafka-python consumer poll/commit/pause interface over a list of
+    message values on one partition, commits take one broker
+    round-trip
+
+    Args:
+        values (list): Message values, consumed in order
+        rtt (float): Injected round-trip time of a commit in seconds
+        topic (string): Topic of the records
+    """
+
+    def __init__(self, values, rtt=0.002, topic='WebMonitor'):
+        self._values = collections.deque(values)
+        self.rtt = rtt
+        self.partition = TopicPartition(topic, 0)
+        self._offset = 0
+        self._paused = set()
+        # Poll time of every uncommitted offset
+        self._polled = collections.deque()
+        self.committed = 0
+        self.commits = 0
+        self.pauses = 0
+        # Seconds from poll to commit of every committed record
+        self.latencies = []
+
+    def poll(self, timeout_ms=0, max_records=None):
+        assert max_records is None or max_records > 0
+        if not self._values or self.partition in self._paused:
+            time.sleep(timeout_ms / 1000)
+            return {}
+        count = min(max_records or len(self._values), len(self._values))
+        now = time.perf_counter()
+        records = []
+        for _ in range(count):
+            records.append(ConsumerRecord(*self.partition, self._offset,
+                                          self._values.popleft()))
+            self._polled.append(now)
+            self._offset += 1
+        return {self.partition: records}
+
+    def assignment(self):
+        return {self.partition}
+
+    def pause(self, *partitions):
+        if partitions and not self._paused:
+            self.pauses += 1
+        self._paused.update(partitions)
+
+    def resume(self, *partitions):
+        self._paused.difference_update(partitions)
+
+    def paused(self):
+        return set(self._paused)
+
+    def commit(self, offsets=None):
+        time.sleep(self.rtt)
+        self.commits += 1
+        if offsets and self.partition in offsets:
+            now = time.perf_counter()
+            while self.committed < offsets[self.partition].offset:
+                self.latencies.append(now - self._polled.popleft())
+                self.committed += 1
+
+    def close(self):
+        pass
+
+
+class _StandInCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def mogrify(self, template, args):
+        from psycopg2.extensions import adapt
+        if isinstance(template, bytes):
+            template = template.decode()
+        return (template % tuple(adapt(arg).getquoted().decode()
+                                 for arg in args)).encode()
+
+    def execute(self, sql, args=None):
+        time.sleep(self.connection.rtt)
+        self.connection._check()
+        self.connection.statements += 1
+        self.connection._reject(sql)
+        self.connection.bytes += len(sql)
+
+
+class StandInPostgres:
+    """psycopg2 connection interface that executes nothing, every
+    statement and commit takes one round-trip
+
+    outage() makes the server unreachable for a while: statements fail
+    with OperationalError and close the connection, connect() fails
+    until the outage is over.
+
+    Args:
+        rtt (float): Injected round-trip time in seconds
+        reject (bytes, optional): Statements containing it fail with
+            DataError, like a value Postgres can not store
+    """
+    encoding = 'UTF8'
+
+    def __init__(self, rtt=0.002, reject=None):
+        self.rtt = rtt
+        self.reject = reject
+        self.rejected = 0
+        self.statements = 0
+        self.commits = 0
+        self.bytes = 0
+        self.failures = 0
+        self.closed = 0
+        self._down_until = 0
+
+    def outage(self, seconds):
+        self._down_until = time.monotonic() + seconds
+
+    def _check(self):
+        import psycopg2
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if time.monotonic() < self._down_until:
+            self.failures += 1
+            self.closed = 2
+            raise psycopg2.OperationalError('server closed the connection')
+
+    def _reject(self, sql):
+        import psycopg2
+        if self.reject and self.reject in sql:
+            self.rejected += 1
+            raise psycopg2.DataError('invalid input syntax')
+
+    def connect(self):
+        """Reopen the connection, returns it"""
+        import psycopg2
+        time.sleep(self.rtt)
+        if time.monotonic() < self._down_until:
+            raise psycopg2.OperationalError('could not connect to server')
+        self.closed = 0
+        return self
+
+    def cursor(self):
+        return _StandInCursor(self)
+
+    def commit(self):
+        time.sleep(self.rtt)
+        self._check()
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
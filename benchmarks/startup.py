@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Benchmark cold start of every tool with an import time profile
+
+Starts a new interpreter per run with python -X importtime, for the
+command line help of every tool and for the imports (and settings) of
+every web-monitor mode, without connecting anywhere. Reports one
+result per command, with the slowest top-level imports of the last
+run. Run it with an interpreter that has all tools installed:
+
+    python ../benchmarks/startup.py --runs 10
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import click
+
+from harness import summarize
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Name: tool directory and interpreter arguments
+COMMANDS = {
+    'web-monitor.help': ('web-monitor', ['main.py', '--help']),
+    'web-monitor.producer': ('web-monitor', [
+        '-c', 'import main, probe, producer, scheduler, metrics\n'
+              'main.settings.kafka_topic']),
+    'web-monitor.consumer': ('web-monitor', [
+        '-c', 'import main, consumer, metrics\n'
+              'main.settings.kafka_topic']),
+    'web-monitor.migrate': ('web-monitor', [
+        '-c', 'import main, schema\nmain.settings.kafka_topic']),
+    'web-backup.help': ('web-backup', ['main.py', '--help']),
+    'youtube-videos.help': ('youtube-videos', ['main.py', '--help']),
+    'heic2jpg.help': ('heic2jpg', ['main.py', '--help']),
+}
+
+
+def import_profile(stderr, top):
+    """Returns the top slowest top-level imports of python -X importtime
+    output as (module, cumulative ms)"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented
+        if name.startswith('  ') or not cumulative.strip().isdigit():
+            continue
+        imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda i: -i[1])[:top]
+
+
+def run(name, python, runs, top):
+    directory, args = COMMANDS[name]
+    # Stand-in for the secret web-monitor keeps in .secrets.yaml
+    env = dict(os.environ)
+    env.setdefault('DYNACONF_POSTGRES_PASSWORD', 'stand-in')
+    latencies = []
+    peak = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.Popen([python, '-X', 'importtime', *args],
+                                cwd=os.path.join(ROOT, directory), env=env,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        stderr = proc.stderr.read()
+        # Resource usage of this start only, ru_maxrss is in KB
+        _, status, usage = os.wait4(proc.pid, 0)
+        latencies.append(time.perf_counter() - start)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        proc.stderr.close()
+        if proc.returncode:
+            raise click.ClickException(f'{name} failed:\n{stderr}')
+        peak = max(peak, usage.ru_maxrss)
+    result = summarize(name, runs, sum(latencies), latencies, unit='starts',
+                       top_imports=import_profile(stderr, top))
+    result['peak_rss_mb'] = round(peak / 1024, 1)
+    return result
+
+
+@click.command()
+@click.option('--runs', default=10, help='Starts per command')
+@click.option('--top', default=8, help='Slowest imports to report')
+@click.option('--only', multiple=True, type=click.Choice(list(COMMANDS)))
+@click.option('--python', default=sys.executable,
+              help='Python interpreter with the tools installed')
+def main(runs, top, only, python):
+    print(json.dumps([run(name, python, runs, top)
+                      for name in only or COMMANDS], indent=2))
+
+
+if __name__ == '__main__':
+    main()
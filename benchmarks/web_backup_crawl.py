@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Benchmark a web-backup crawl
+
+Crawls a local fixture server, which answers after an injected
+latency, with the saved listing pages in fixtures/web-backup as the
+month listings and generated articles. Files, manifest and archive are
+written to a temporary directory. Run it from the web-backup virtual
+environment:
+
+    cd web-backup && pipenv run python ../benchmarks/web_backup_crawl.py
+"""
+import contextlib
+import glob
+import os
+import re
+import sys
+import tempfile
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'web-backup'))
+import main as web_backup  # noqa: E402
+from archive import Archive  # noqa: E402
+from frontier import Frontier  # noqa: E402
+from manifest import Manifest  # noqa: E402
+from parsers import BACKENDS, get_backend  # noqa: E402
+from harness import Latencies, emit, summarize  # noqa: E402
+from standins import FixtureServer  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'web-backup')
+SITE = 'https://blog.example'
+PARAGRAPH = ('<p>Backups are only as good as the last restore test of '
+             'the archive they were written to.</p>\n')
+
+
+def site_routes(base, article_kb):
+    """Returns the routes of the fixture site: month listings from the
+    saved pages, months alternating between the two-page and the
+    one-page listing, and generated articles"""
+    templates = {}
+    for path in glob.glob(os.path.join(FIXTURES, '*.html')):
+        with open(path) as f:
+            templates[os.path.basename(path)] = f.read().replace(SITE, base)
+    paragraphs = PARAGRAPH * (article_kb * 1024 // len(PARAGRAPH) + 1)
+
+    def listing(name, year, month, source):
+        html = templates[name].replace(source, f'/{year}/{month}/')
+        return html.encode()
+
+    def route(path):
+        match = re.fullmatch(r'/(\d+)/(\d+)/(page/(\d+)/?)?', path)
+        if match:
+            year, month = int(match[1]), int(match[2])
+            if month % 2:
+                if match[3]:
+                    return None
+                return listing('listing-2022-8.html', year, month, '/2022/8/')
+            name = ('listing-2022-9-page-2.html' if match[3]
+                    else 'listing-2022-9.html')
+            return listing(name, year, month, '/2022/9/')
+        return (f'<html><head><title>{path}</title></head><body>'
+                f'<h1>{path}</h1>{paragraphs}</body></html>').encode()
+    return route
+
+
+@click.command()
+@click.option('--months', default=24, help='Months to crawl, up to 2021/12')
+@click.option('--workers', default=8, help='Worker threads')
+@click.option('--latency', default=0.02, help='Server latency in seconds')
+@click.option('--article_kb', default=32, help='Article size in KB')
+@click.option('--parser', default='auto',
+              type=click.Choice(['auto', *BACKENDS]))
+@click.option('--storage', default='files',
+              type=click.Choice(['files', 'archive']))
+def main(months, workers, latency, article_kb, parser, storage):
+    # Past months only, so completed months are recorded too
+    crawled = [(2021 - i // 12, 12 - i % 12) for i in range(months)]
+    latencies = Latencies()
+    get_html = web_backup.get_html
+
+    def timed_get_html(*args, **kwargs):
+        with latencies.time():
+            return get_html(*args, **kwargs)
+    web_backup.get_html = timed_get_html
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            FixtureServer(None, latency=latency) as server:
+        server.routes = site_routes(server.url, article_kb)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            manifest = Manifest('manifest.sqlite')
+            frontier = Frontier('manifest.sqlite')
+            archive = Archive('archive') if storage == 'archive' else None
+            backend = get_backend(parser)
+            start = time.perf_counter()
+            # get_data prints every headline
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                web_backup.crawl(server.url, crawled, workers, 1000, 0,
+                                 manifest, backend, frontier, archive=archive)
+            seconds = time.perf_counter() - start
+            frontier.close()
+            manifest.close()
+            if archive:
+                archive.close()
+        finally:
+            os.chdir(cwd)
+    emit(summarize('web-backup.crawl', len(latencies.values), seconds,
+                   latencies.values, unit='pages', months=months,
+                   workers=workers, latency=latency, parser=backend.name,
+                   storage=storage, requests=server.requests))
+
+
+if __name__ == '__main__':
+    main()
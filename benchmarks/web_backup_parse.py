@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Benchmark web-backup listing page parsing backends
+
+Parses the listing pages in fixtures/web-backup with every installed
+backend, checks they all extract the same pagination and articles and
+compares them with the old full BeautifulSoup parse. Besides the saved
+listing pages the fixtures cover a page without charset declaration
+and nested (list) pagination.
+Run it from the web-backup virtual environment:
+
+    cd web-backup && pipenv run python ../benchmarks/web_backup_parse.py
+"""
+import glob
+import os
+import sys
+import time
+import click
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'web-backup'))
+from parsers import BACKENDS  # noqa: E402
+from harness import emit, summarize  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'web-backup')
+
+
+def full_soup_listing(html):
+    """Listing extraction as web-backup did it before the parsing
+    backends: a full html.parser tree, parsed once per lookup"""
+    soup = BeautifulSoup(html, "html.parser")
+    pages = [page.text for page in soup.find_all(
+        attrs={"class": "page-numbers"})]
+    soup = BeautifulSoup(html, "html.parser")
+    return pages, [(htm.text, htm.a.get("href") if htm.a else None)
+                   for htm in soup.find_all(attrs={"itemprop": "headline"})]
+
+
+def run(name, listing, pages, rounds):
+    """Returns the result of parsing every page rounds times, latencies
+    are per page"""
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for html in pages:
+            parsed = time.perf_counter()
+            listing(html)
+            latencies.append(time.perf_counter() - parsed)
+    seconds = time.perf_counter() - start
+    return summarize(f'web-backup.parse.{name}', len(latencies), seconds,
+                     latencies, unit='pages', rounds=rounds)
+
+
+@click.command()
+@click.option('--rounds', default=50, help='Parses of every fixture page')
+def main(rounds):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+
+    parsers = {'full_soup': full_soup_listing}
+    for name, backend in BACKENDS.items():
+        try:
+            parsers[name] = backend().listing
+        except ImportError:
+            print(f"Skipping {name}: not installed", file=sys.stderr)
+
+    expected = [full_soup_listing(html) for html in pages]
+    results = []
+    for name, listing in parsers.items():
+        if [listing(html) for html in pages] != expected:
+            sys.exit(f"{name} does not match the full_soup results")
+        results.append(run(name, listing, pages, rounds))
+    # Peak RSS of a backend includes the backends before it
+    for result in results:
+        result['params']['speedup'] = round(
+            result['throughput'] / results[0]['throughput'], 1)
+    emit(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Benchmark web-monitor consumer micro-batching
+
+Runs the consumer loop of consume_events over a stand-in Kafka
+consumer and writes the batches to a stand-in Postgres connection,
+both with an injected round-trip time. Rows are rendered by psycopg2
+as for a real database. Latencies are from poll to offset commit.
+--outage makes Postgres unreachable for a while after the first
+batch, to check that consumption pauses and every event is stored.
+--invalid spreads events with a status code Postgres rejects over the
+run, to check that the rest of their batches is stored and committed.
+Run it from the web-monitor directory and virtual environment:
+
+    cd web-monitor && pipenv run python ../benchmarks/web_monitor_consumer.py
+"""
+import datetime
+import os
+import sys
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'web-monitor'))
+# Postgres is a stand-in, the password is never used
+os.environ.setdefault('DYNACONF_POSTGRES_PASSWORD', 'stand-in')
+from consumer import EventBatcher, consume  # noqa: E402
+from harness import emit, summarize  # noqa: E402
+from standins import StandInConsumer, StandInPostgres  # noqa: E402
+
+# Status code of invalid events, the stand-in Postgres rejects it
+INVALID_STATUS = 'invalid'
+
+
+def events(count, invalid=0):
+    checked_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    every = count // invalid if invalid else 0
+    for i in range(count):
+        yield {
+            'url': f'https://site-{i % 1000}.example/',
+            'status_code': (INVALID_STATUS if every and i % every == every - 1
+                            else 200),
+            'response_time': 0.123456,
+            'response_body_regex': True,
+            'checked_at': checked_at,
+            'dns_time': 0.001,
+            'connect_time': 0.01,
+            'tls_time': 0.02,
+            'ttfb_time': 0.09,
+            'download_time': 0.003
+        }
+
+
+class Committed:
+    """True once the consumer committed count events"""
+
+    def __init__(self, consumer, count):
+        self.consumer = consumer
+        self.count = count
+
+    def __bool__(self):
+        return self.consumer.committed >= self.count
+
+
+@click.command()
+@click.option('--count', default=20000, help='Events to consume')
+@click.option('--rtt', default=0.002,
+              help='Kafka and Postgres round-trip in seconds')
+@click.option('--batch_size', default=500, help='Events per batch')
+@click.option('--batch_timeout_ms', default=1000, help='Maximum batch age')
+@click.option('--max_pending', default=4,
+              help='Batches waiting to be written')
+@click.option('--outage', default=0.0,
+              help='Seconds Postgres is unreachable after the first batch')
+@click.option('--invalid', default=0,
+              help='Events Postgres rejects, spread over the run')
+def main(count, rtt, batch_size, batch_timeout_ms, max_pending, outage,
+         invalid):
+    consumer = StandInConsumer(events(count, invalid), rtt=rtt)
+    pgconn = StandInPostgres(rtt=rtt,
+                             reject=f"'{INVALID_STATUS}'".encode())
+    batcher = EventBatcher(pgconn, consumer, batch_size=batch_size,
+                           batch_timeout_ms=batch_timeout_ms,
+                           max_pending=max_pending, connect=pgconn.connect)
+    if outage:
+        # Starts once the first batch is written
+        commit = pgconn.commit
+
+        def commit_then_fail():
+            commit()
+            pgconn.commit = commit
+            pgconn.outage(outage)
+        pgconn.commit = commit_then_fail
+    start = time.perf_counter()
+    consume(consumer, batcher, Committed(consumer, count))
+    seconds = time.perf_counter() - start
+    emit(summarize('web-monitor.consumer', consumer.committed, seconds,
+                   consumer.latencies, unit='events', rtt=rtt,
+                   batch_size=batch_size, max_pending=max_pending,
+                   outage=outage, invalid=invalid,
+                   statements=pgconn.statements,
+                   rejected_statements=pgconn.rejected,
+                   commits=consumer.commits, pauses=consumer.pauses,
+                   write_failures=pgconn.failures,
+                   sql_mb=round(pgconn.bytes / 1024 / 1024, 2)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Benchmark web-monitor website checks
+
+Checks URLs of a local fixture server, which answers after an injected
+latency, with the probe engine of the producer. Run it from the
+web-monitor directory and virtual environment:
+
+    cd web-monitor && pipenv run python ../benchmarks/web_monitor_probe.py
+"""
+import asyncio
+import os
+import sys
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'web-monitor'))
+# Only the settings of the probe are used, no Postgres connection
+os.environ.setdefault('DYNACONF_POSTGRES_PASSWORD', 'stand-in')
+from probe import Prober  # noqa: E402
+from harness import emit, summarize  # noqa: E402
+from standins import FixtureServer  # noqa: E402
+
+BODY = (b'<!DOCTYPE html><html><head><title>CSS1Compat</title></head><body>'
+        + b'<p>Lorem ipsum dolor sit amet</p>' * 1000 + b'</body></html>')
+
+
+async def run(urls, rounds, concurrency, limit_per_host):
+    """Returns the messages of all checks and the connections per host
+    limit used"""
+    messages = []
+    async with Prober(concurrency=concurrency,
+                      limit_per_host=limit_per_host) as prober:
+        for _ in range(rounds):
+            messages += await prober.check_all(urls)
+    return messages, prober.limit_per_host
+
+
+@click.command()
+@click.option('--urls', default=200, help='URLs per round')
+@click.option('--rounds', default=5, help='Checks of every URL')
+@click.option('--latency', default=0.05, help='Server latency in seconds')
+@click.option('--concurrency', default=100, help='Checks running at once')
+# All URLs are on the one fixture server host, checks beyond the limit
+# wait for a connection without it counting as response time
+@click.option('--limit_per_host', type=int,
+              help='Connections per host, defaults to the '
+                   'probe_limit_per_host setting')
+def main(urls, rounds, latency, concurrency, limit_per_host):
+    with FixtureServer(lambda path: BODY, latency=latency) as server:
+        paths = [f'{server.url}/site-{i}' for i in range(urls)]
+        start = time.perf_counter()
+        messages, limit_per_host = asyncio.run(
+            run(paths, rounds, concurrency, limit_per_host))
+        seconds = time.perf_counter() - start
+    failed = sum(1 for m in messages if m['status_code'] != 200)
+    emit(summarize('web-monitor.probe', len(messages), seconds,
+                   [m['response_time'] for m in messages
+                    if m['response_time'] is not None],
+                   unit='checks', latency=latency, concurrency=concurrency,
+                   limit_per_host=limit_per_host, failed=failed,
+                   requests=server.requests))
+
+
+if __name__ == '__main__':
+    main()
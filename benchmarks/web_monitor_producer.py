@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Benchmark web-monitor producer: flush per message vs batched sends
+
+Both runs use the kafka.KafkaProducer built by producer.create_producer()
+from the web-monitor settings (kafka_linger_ms, kafka_batch_size,
+kafka_compression_type), only the bootstrap servers point to a local
+stand-in Kafka broker with an injected round-trip time per produce
+request, no Kafka needed. Run it from the web-monitor virtual
+environment:
+
+    cd web-monitor && pipenv run python ../benchmarks/web_monitor_producer.py
+"""
+import os
+import sys
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'web-monitor'))
+# The stand-in broker port changes every run, do not cache the settings
+os.environ.setdefault('WEB_MONITOR_SETTINGS_CACHE', '')
+# Postgres is not used, the password is never read
+os.environ.setdefault('DYNACONF_POSTGRES_PASSWORD', 'stand-in')
+from producer import DeliveryStats, create_producer, send  # noqa: E402
+from harness import emit, summarize  # noqa: E402
+from standins import StandInKafkaBroker  # noqa: E402
+
+
+def messages(count):
+    for i in range(count):
+        yield {
+            'url': f'https://site-{i % 1000}.example/',
+            'status_code': 200,
+            'response_time': 0.123456,
+            'response_body_regex': True
+        }
+
+
+def run(broker, count, flush_each, **params):
+    """Returns the result of one run, latencies are from send to
+    delivery of every message"""
+    producer = create_producer()
+    stats = DeliveryStats()
+    latencies = []
+    requests = broker.requests
+    wire_bytes = broker.bytes
+    start = time.perf_counter()
+    for message in messages(count):
+        sent = time.perf_counter()
+        send(producer, 'WebMonitor', message, stats).add_callback(
+            lambda metadata, sent=sent: latencies.append(
+                time.perf_counter() - sent))
+        if flush_each:
+            producer.flush()
+    producer.flush()
+    seconds = time.perf_counter() - start
+    result = stats.report()
+    producer.close()
+    name = 'flush_per_message' if flush_each else 'batched'
+    return summarize(f'web-monitor.producer.{name}', result['delivered'],
+                     seconds, latencies, unit='messages',
+                     requests=broker.requests - requests,
+                     wire_kb=round((broker.bytes - wire_bytes) / 1024, 1),
+                     **params)
+
+
+@click.command()
+@click.option('--count', default=2000, help='Messages per run')
+@click.option('--rtt', default=0.005, help='Broker round-trip in seconds')
+@click.option('--linger_ms', type=int,
+              help='Override the kafka_linger_ms setting')
+@click.option('--batch_size', type=int,
+              help='Override the kafka_batch_size setting')
+@click.option('--compression_type',
+              help="Override the kafka_compression_type setting, 'none' "
+                   "disables compression")
+def main(count, rtt, linger_ms, batch_size, compression_type):
+    if compression_type == 'none':
+        compression_type = '@none'
+    overrides = {'LINGER_MS': linger_ms, 'BATCH_SIZE': batch_size,
+                 'COMPRESSION_TYPE': compression_type}
+    for name, value in overrides.items():
+        if value is not None:
+            os.environ[f'DYNACONF_KAFKA_{name}'] = str(value)
+    with StandInKafkaBroker(rtt=rtt) as broker:
+        os.environ['DYNACONF_KAFKA_BOOTSTRAP_SERVERS'] = \
+            broker.bootstrap_servers
+        os.environ['DYNACONF_KAFKA_SECURITY_PROTOCOL'] = 'PLAINTEXT'
+        results = [run(broker, count, True, rtt=rtt),
+                   run(broker, count, False, rtt=rtt)]
+    # Peak RSS of a run includes the runs before it
+    for result in results:
+        result['params']['speedup'] = round(
+            result['throughput'] / results[0]['throughput'], 1)
+    emit(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Benchmark youtube-videos downloads
+
+Downloads videos from a local fake video stream server, which answers
+after an injected latency and serves byte ranges like YouTube stream
+URLs. A stand-in for pytube's YouTube fetches a watch page from the
+same server for the metadata. Videos and index are written to a
+temporary directory. Run it from the youtube-videos virtual
+environment:
+
+    cd youtube-videos && pipenv run python \
+        ../benchmarks/youtube_videos_download.py
+"""
+import contextlib
+import datetime
+import os
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'youtube-videos'))
+import main as youtube_videos  # noqa: E402
+from videoindex import VideoIndex  # noqa: E402
+from harness import Latencies, emit, summarize  # noqa: E402
+from standins import FixtureServer  # noqa: E402
+
+WATCH_PAGE = b'<html><body>' + b'<script>var ytInitialData = {};</script>' \
+    * 10000 + b'</body></html>'
+
+
+class StandInStream:
+    """The parts of pytube.Stream used by download_stream"""
+
+    def __init__(self, url, title, filesize, itag=22):
+        self.url = url
+        self.title = title
+        self.filesize = filesize
+        self.itag = itag
+
+    def get_file_path(self, output_path):
+        return os.path.join(output_path, f'{self.title}.mp4')
+
+    def exists_at_path(self, file):
+        return os.path.isfile(file) and os.path.getsize(file) == self.filesize
+
+
+class StandInStreams:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def get_highest_resolution(self):
+        return self.stream
+
+    get_lowest_resolution = get_highest_resolution
+
+
+def stand_in_youtube(server, filesize):
+    """Returns a pytube YouTube stand-in whose metadata and streams come
+    from the fixture server"""
+
+    class StandInYouTube:
+
+        def __init__(self, url):
+            self.video_id = url.rsplit('=', 1)[1]
+            with urlopen(f'{server.url}/watch?v={self.video_id}') as r:
+                r.read()
+            self.title = f'Video {self.video_id}'
+            self.publish_date = datetime.datetime(
+                2022, 9, 1, tzinfo=datetime.timezone.utc)
+            self.streams = StandInStreams(StandInStream(
+                f'{server.url}/videoplayback/{self.video_id}?itag=22',
+                self.title, filesize))
+    return StandInYouTube
+
+
+@click.command()
+@click.option('--videos', default=16, help='Videos to download')
+@click.option('--video_mb', default=32, help='Video size in MB')
+@click.option('--latency', default=0.02, help='Server latency in seconds')
+@click.option('--metadata_workers', default=4)
+@click.option('--download_workers', default=2)
+def main(videos, video_mb, latency, metadata_workers, download_workers):
+    payload = os.urandom(video_mb * 1024 * 1024)
+
+    def route(path):
+        if path == '/watch':
+            return WATCH_PAGE
+        if path.startswith('/videoplayback/'):
+            return payload
+        return None
+
+    latencies = Latencies()
+    get_video = youtube_videos.get_video
+
+    def timed_get_video(*args, **kwargs):
+        with latencies.time():
+            return get_video(*args, **kwargs)
+    youtube_videos.get_video = timed_get_video
+
+    urls = [f'https://www.youtube.com/watch?v=video{i:06d}'
+            for i in range(videos)]
+    with tempfile.TemporaryDirectory() as tmp, \
+            FixtureServer(route, latency=latency,
+                          content_type='video/mp4') as server:
+        youtube_videos.YouTube = stand_in_youtube(server, len(payload))
+        index = VideoIndex(os.path.join(tmp, 'videos.sqlite'))
+        start = time.perf_counter()
+        # get_video prints every downloaded file
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            downloaded = youtube_videos.download_videos(
+                urls, 'high', tmp, index, metadata_workers,
+                download_workers)
+        seconds = time.perf_counter() - start
+        index.close()
+    emit(summarize('youtube-videos.download', downloaded, seconds,
+                   latencies.values, unit='videos', video_mb=video_mb,
+                   latency=latency, metadata_workers=metadata_workers,
+                   download_workers=download_workers,
+                   mb_per_s=round(downloaded * video_mb / seconds, 1),
+                   requests=server.requests))
+
+
+if __name__ == '__main__':
+    main()
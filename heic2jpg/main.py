@@ -1,72 +1,343 @@
 import os
-import subprocess
-import glob
+import hashlib
+import io
+import json
 import logging
+import time
+from concurrent import futures
+import click
 
 
-def convert_heic_to_jpg(dir):
-    """Convert HEIC files to JPG"""
+def init_worker():
+    """Register the HEIF opener with Pillow in a worker process"""
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+
+
+# Initial estimate of the memory needed to convert a HEIC file, as a
+# multiple of its size, see convert_heic_to_jpg
+MEMORY_RATIO = 20
+
+
+def convert_file(path, quality):
+    """Convert one HEIC file to a JPG next to it
+
+    The EXIF (orientation reset to 1 as the image is already rotated)
+    and ICC profile of the decoded image are copied to the JPG, which
+    is written to a temporary file and renamed into place.
+
+    Args:
+        path (string): HEIC file
+        quality (int): JPEG quality, 1-95
+
+    Returns:
+        dict: jpg file, its size and dimensions and the SHA-256 of
+            the HEIC file, plus timings and memory used that are not
+            part of the state
+    """
+    from PIL import Image
+    jpg = os.path.splitext(path)[0] + '.jpg'
+    tmp = f'{jpg}.{os.getpid()}.tmp'
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        decoded = time.perf_counter()
+        rgb = img if img.mode == 'RGB' else img.convert('RGB')
+        memory = len(data) + len(img.getbands()) * img.width * img.height
+        if rgb is not img:
+            memory += 3 * img.width * img.height
+        try:
+            rgb.save(tmp, 'JPEG', quality=quality,
+                     exif=img.info.get('exif') or b'',
+                     icc_profile=img.info.get('icc_profile'))
+            os.replace(tmp, jpg)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        width, height = img.size
+    return {'sha256': hashlib.sha256(data).hexdigest(), 'jpg': jpg,
+            'jpg_size': os.path.getsize(jpg), 'width': width,
+            'height': height,
+            'stats': {'decode': decoded - start,
+                      'encode': time.perf_counter() - decoded,
+                      'memory': memory}}
+
+
+def file_sha256(path):
+    """Returns the SHA-256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan(dir):
+    """Find HEIC files in dir and all its subdirectories in one pass
+
+    Args:
+        dir (string): Directory
+
+    Returns:
+        dict: os.stat_result of every HEIC file by path
+    """
+    found = {}
+    pending = [dir]
+    while pending:
+        path = pending.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif (entry.is_file()
+                          and entry.name.upper().endswith('.HEIC')):
+                        found[entry.path] = entry.stat()
+        except OSError as e:
+            logging.error(f'Cannot scan {path}: {e}')
+    logging.info(f'Found {len(found)} HEIC files in {dir}')
+    return found
+
+
+def load_state(path):
+    """Returns the conversion state by HEIC file, see save_state"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    """Write the conversion state atomically
+
+    Every converted HEIC file is recorded with its mtime, size and
+    SHA-256 and its JPG with size and dimensions.
+
+    Args:
+        path (string): State file
+        state (dict): Conversion state by HEIC file
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def jpg_matches(entry):
+    """Returns True if the JPG recorded in a state entry exists with
+    its recorded size"""
+    try:
+        return os.path.getsize(entry['jpg']) == entry['jpg_size']
+    except OSError:
+        return False
+
+
+def needs_conversion(path, stat, state):
+    """Returns True if a HEIC file is new or changed since it was
+    converted, or its JPG is missing
+
+    An unchanged file with a new mtime only gets its state updated.
+    """
+    entry = state.get(path)
+    if not entry or not jpg_matches(entry):
+        return True
+    if entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return False
+    if entry['size'] == stat.st_size and entry['sha256'] == file_sha256(path):
+        entry['mtime'] = stat.st_mtime_ns
+        return False
+    return True
+
+
+def convert_heic_to_jpg(heic_files, state, workers=None, quality=92,
+                        memory=1024 * 1024 * 1024):
+    """Convert HEIC files to JPG
+
+    HEIC files are decoded in-process by a pool of worker processes,
+    one file per task. Files converted before and unchanged since are
+    skipped.
+
+    Files are handed to the workers as a stream: a file is only
+    submitted while the estimated memory of all submitted files stays
+    within the memory budget (at least one file is always in
+    progress). The estimate is the file size times the largest
+    memory/size ratio measured so far, starting at MEMORY_RATIO.
+
+    Args:
+        heic_files (dict): os.stat_result by HEIC file, see scan
+        state (dict): Conversion state, updated with the converted files
+        workers (int, optional): Worker processes. Defaults to the
+            number of CPUs.
+        quality (int, optional): JPEG quality. Defaults to 92.
+        memory (int, optional): Memory budget in bytes.
+            Defaults to 1 GiB.
+
+    Returns:
+        dict: converted files, seconds, seconds per converted file
+            from submit to result and peak memory estimate, None on
+            errors
+    """
     try:
-        for root, dirs, files in os.walk(dir):
-            for name in dirs:
-                fullpath = os.path.join(root, name)
-                ftype = ".HEIC"
-                files = glob.glob(fullpath + f'/*{ftype}')
-                # list only directories that have HEIC files
-                if len([name for name in os.listdir(fullpath)
-                        if name.endswith(ftype)]) > 0:
+        todo = [f for f, stat in heic_files.items()
+                if needs_conversion(f, stat, state)]
+        logging.info(f'Converting {len(todo)} new or changed HEIC files, '
+                     f'{len(heic_files) - len(todo)} unchanged')
+
+        start = time.monotonic()
+        converted = 0
+        ratio = MEMORY_RATIO
+        # Estimated memory of the submitted files
+        reserved = 0
+        peak = 0
+        source_bytes = 0
+        pixels = 0
+        durations = []
+        queue = iter(todo)
+        path = next(queue, None)
+        pending = {}
+        with futures.ProcessPoolExecutor(workers,
+                                         initializer=init_worker) as pool:
+            while True:
+                while path is not None:
+                    estimate = heic_files[path].st_size * ratio
+                    if pending and reserved + estimate > memory:
+                        break
+                    pending[pool.submit(convert_file, path, quality)] = (
+                        path, estimate, time.monotonic())
+                    reserved += estimate
+                    peak = max(peak, reserved)
+                    path = next(queue, None)
+                if not pending:
+                    break
+                done, _ = futures.wait(pending,
+                                       return_when=futures.FIRST_COMPLETED)
+                for task in done:
+                    heic, estimate, submitted = pending.pop(task)
+                    reserved -= estimate
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logging.error(f'Error converting {heic}: {e}')
+                        state.pop(heic, None)
+                        continue
+                    stats = result.pop('stats')
+                    stat = heic_files[heic]
+                    ratio = max(ratio, stats['memory'] / stat.st_size)
+                    state[heic] = dict(result, mtime=stat.st_mtime_ns,
+                                       size=stat.st_size)
+                    megapixels = result['width'] * result['height'] / 1e6
+                    durations.append(time.monotonic() - submitted)
                     logging.info(
-                        f'Found HEIC files in: {fullpath} , converting to JPG')
-                    # use glob to find HEIC files in fullpath and log them
-                    for f in files:
-                        logging.info(f'Found {f}')
-
-                    subprocess.run(
-                        ['mogrify', '-format', 'jpg', fullpath + f'/*{ftype}'])
-                else:
-                    logging.info(f'No HEIC files in: {fullpath}')
+                        f'Converted {heic} to {result["jpg"]} in '
+                        f'{durations[-1]:.2f}s (decode '
+                        f'{stats["decode"]:.2f}s, encode '
+                        f'{stats["encode"]:.2f}s, {megapixels:.1f} MP, '
+                        f'{stats["memory"] / 1024 / 1024:.1f} MB)')
+                    converted += 1
+                    source_bytes += stat.st_size
+                    pixels += result['width'] * result['height']
+        seconds = time.monotonic() - start
+        logging.info(f'Converted {converted}/{len(todo)} files in '
+                     f'{seconds:.1f}s')
+        if seconds > 0:
+            logging.info(
+                f'Throughput: {converted / seconds:.1f} files/s, '
+                f'{source_bytes / seconds / 1024 / 1024:.1f} MB/s HEIC, '
+                f'{pixels / seconds / 1e6:.1f} MP/s, peak memory '
+                f'estimate {peak / 1024 / 1024:.0f} MB')
+        return {'converted': converted, 'seconds': seconds,
+                'durations': durations, 'peak_memory': peak}
     except Exception as e:
         logging.error(e)
 
 
-def delete_heic_files(dir):
+def jpg_verified(entry):
+    """Returns True if the JPG of a state entry is a valid JPEG with
+    the recorded size and dimensions"""
+    from PIL import Image
+    if not jpg_matches(entry):
+        return False
+    try:
+        with Image.open(entry['jpg']) as img:
+            if (img.format != 'JPEG'
+                    or img.size != (entry['width'], entry['height'])):
+                return False
+            img.verify()
+        return True
+    except Exception:
+        return False
+
+
+def delete_heic_files(heic_files, state):
     """Remove HEIC files after conversion
+
+    A HEIC file is only removed if it did not change since it was
+    converted and its JPG is verified.
+
+    Args:
+        heic_files (dict): os.stat_result by HEIC file, see scan
+        state (dict): Conversion state, deleted files are removed
     """
     try:
-        for root, dirs, files in os.walk(dir):
-            for name in dirs:
-                fullpath = os.path.join(root, name)
-                ftype = ".HEIC"
-                files = glob.glob(fullpath + f'/*{ftype}')
-                # Delete HEIC files after conversion and if jpg files exist
-                if len([name for name in os.listdir(fullpath)
-                        if name.endswith('.jpg')]) > 0 and \
-                        len([name for name in os.listdir(fullpath)
-                             if name.endswith(ftype)]) > 0:
-                    logging.info(
-                        f'Deleting HEIC files in: {fullpath}')
-                    for f in files:
-                        logging.info(f'Deleting {f}')
-                        os.remove(f)
+        for path, stat in heic_files.items():
+            entry = state.get(path)
+            if not entry or entry['size'] != stat.st_size or \
+                    entry['mtime'] != stat.st_mtime_ns:
+                logging.info(f'Keeping unconverted {path}')
+                continue
+            if not jpg_verified(entry):
+                logging.error(f'Keeping {path}, JPG not verified: '
+                              f'{entry["jpg"]}')
+                continue
+            logging.info(f'Deleting {path}')
+            os.remove(path)
+            del state[path]
     except Exception as e:
         logging.error(e)
 
 
-def main():
+@click.command()
+@click.option('--dir', 'directory', help='HEIC files directory',
+              default='./')
+@click.option('--workers', help='Worker processes, defaults to CPU count',
+              type=int)
+@click.option('--quality', help='JPEG quality', default=92,
+              type=click.IntRange(1, 95))
+@click.option('--state', 'state_file', help='Conversion state file, '
+              'defaults to <dir>/.heic2jpg-state.json')
+@click.option('--keep', help='Keep HEIC files after conversion',
+              is_flag=True)
+@click.option('--memory', help='Memory budget of images in conversion, in MB',
+              default=1024, type=click.IntRange(1))
+def main(directory, workers, quality, state_file, keep, memory):
     logging.basicConfig(level=logging.INFO, filename='heic2jpg.log',
                         filemode='w',
                         format='%(asctime)s - %(levelname)s - %(message)s')
     try:
-        directory = './'
-        # Check if mogrify is installed
-        if not os.path.isfile('/usr/bin/mogrify'):
-            logging.error('mogrify not installed, exiting')
-            logging.error('Install it: sudo apt install imagemagick')
+        # Check if pillow-heif is installed
+        try:
+            import pillow_heif  # noqa: F401
+        except ImportError:
+            logging.error('pillow-heif not installed, exiting')
+            logging.error('Install it: pipenv install pillow-heif')
             exit(1)
-        # Convert HEIC files to JPG
-        convert_heic_to_jpg(directory)
-        # Delete HEIC files after conversion and if jpg files exist
-        delete_heic_files(directory)
+        # State is keyed by absolute paths
+        directory = os.path.abspath(directory)
+        state_file = state_file or os.path.join(directory,
+                                                '.heic2jpg-state.json')
+        state = load_state(state_file)
+        heic_files = scan(directory)
+        # Convert new and changed HEIC files to JPG
+        convert_heic_to_jpg(heic_files, state, workers, quality,
+                            memory * 1024 * 1024)
+        save_state(state_file, state)
+        # Delete HEIC files after their jpg files are verified
+        if not keep:
+            delete_heic_files(heic_files, state)
+            save_state(state_file, state)
 
     except Exception as e:
         logging.error(e)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Compressed, deduplicated storage for backed up pages
+
+Pages are stored as content-addressed zstd blobs appended to a few
+large pack files, identical payloads are stored once. A SQLite index
+maps every URL to its blob so single pages can be read back without
+unpacking anything else. Once enough pages were stored a shared zstd
+dictionary is trained from them, later blobs are compressed with it.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import click
+
+# Pages compressed without a dictionary before one is trained
+DICT_SAMPLES = 200
+DICT_SIZE = 112640
+PACK_SIZE = 256 * 1024 * 1024
+LEVEL = 10
+
+
+class Archive:
+    """Content-addressed archive of pages, shared by all worker threads
+
+    Args:
+        path (string): Archive directory
+    """
+
+    def __init__(self, path):
+        import zstandard
+        self.zstd = zstandard
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._dicts = {}
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    pack INTEGER,
+                    offset INTEGER,
+                    length INTEGER,
+                    size INTEGER,
+                    dict_id INTEGER
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT,
+                    name TEXT,
+                    stored_at REAL
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS dicts (
+                    id INTEGER PRIMARY KEY,
+                    data BLOB
+                )
+            """)
+            row = self.db.execute(
+                "SELECT id FROM dicts ORDER BY id DESC LIMIT 1").fetchone()
+            self.dict_id = row[0] if row else 0
+            row = self.db.execute(
+                "SELECT coalesce(max(pack), 1) FROM blobs").fetchone()
+            self.pack = row[0]
+        # Samples for the dictionary, None once trained. Pages stored
+        # before it is trained stay compressed without a dictionary.
+        self.samples = [] if not self.dict_id else None
+
+    def _pack_file(self, pack):
+        return os.path.join(self.path, f"pack-{pack:05d}.zst")
+
+    def _dict(self, dict_id):
+        """Returns the zstd dictionary dict_id, None for 0"""
+        if not dict_id:
+            return None
+        if dict_id not in self._dicts:
+            with self.lock:
+                row = self.db.execute("SELECT data FROM dicts WHERE id = ?",
+                                      (dict_id,)).fetchone()
+            self._dicts[dict_id] = self.zstd.ZstdCompressionDict(row[0])
+        return self._dicts[dict_id]
+
+    def _compressor(self):
+        """Returns this thread's compressor for the current dictionary,
+        zstd compressors must not be shared between threads"""
+        dict_id = self.dict_id
+        if getattr(self._local, 'dict_id', None) != dict_id:
+            self._local.compressor = self.zstd.ZstdCompressor(
+                level=LEVEL, dict_data=self._dict(dict_id))
+            self._local.dict_id = dict_id
+        return self._local.dict_id, self._local.compressor
+
+    def _train(self):
+        """Train the shared dictionary from the collected samples"""
+        samples, self.samples = self.samples, None
+        try:
+            data = self.zstd.train_dictionary(DICT_SIZE, samples).as_bytes()
+        except self.zstd.ZstdError as e:
+            logging.warning(f"Could not train archive dictionary: {e}")
+            return
+        with self.db:
+            cur = self.db.execute("INSERT INTO dicts (data) VALUES (?)",
+                                  (data,))
+        self.dict_id = cur.lastrowid
+        logging.info(f"Trained archive dictionary {self.dict_id} "
+                     f"from {len(samples)} pages")
+
+    def contains(self, url):
+        """Returns True if url is stored"""
+        with self.lock:
+            cur = self.db.execute("SELECT 1 FROM urls WHERE url = ?", (url,))
+            return cur.fetchone() is not None
+
+    def put(self, url, content, name, sha256=None):
+        """Store the content of url, a payload stored before is only
+        referenced again
+
+        Args:
+            url (string): Page URL
+            content (bytes): Page content
+            name (string): File name used when the page is extracted
+            sha256 (string, optional): SHA-256 of content if known
+
+        Returns:
+            boolean: True if the payload was new
+        """
+        sha256 = sha256 or hashlib.sha256(content).hexdigest()
+        with self.lock:
+            new = self.db.execute("SELECT 1 FROM blobs WHERE sha256 = ?",
+                                  (sha256,)).fetchone() is None
+        if new:
+            dict_id, compressor = self._compressor()
+            blob = compressor.compress(content)
+        with self.lock, self.db:
+            if new and self.db.execute("SELECT 1 FROM blobs WHERE sha256 = ?",
+                                       (sha256,)).fetchone() is None:
+                pack_file = self._pack_file(self.pack)
+                if (os.path.exists(pack_file)
+                        and os.path.getsize(pack_file) >= PACK_SIZE):
+                    self.pack += 1
+                    pack_file = self._pack_file(self.pack)
+                with open(pack_file, 'ab') as f:
+                    offset = f.tell()
+                    f.write(blob)
+                self.db.execute(
+                    "INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                    (sha256, self.pack, offset, len(blob), len(content),
+                     dict_id))
+                if self.samples is not None:
+                    self.samples.append(content)
+                    if len(self.samples) >= DICT_SAMPLES:
+                        self._train()
+            else:
+                new = False
+            self.db.execute(
+                "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                (url, sha256, name, time.time()))
+        return new
+
+    def get(self, url):
+        """Returns the stored content of url, None if not stored
+
+        Args:
+            url (string): Page URL
+
+        Returns:
+            bytes: Page content
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT b.pack, b.offset, b.length, b.size, b.dict_id "
+                "FROM urls u JOIN blobs b USING (sha256) WHERE u.url = ?",
+                (url,)).fetchone()
+        if not row:
+            return None
+        pack, offset, length, size, dict_id = row
+        with open(self._pack_file(pack), 'rb') as f:
+            f.seek(offset)
+            blob = f.read(length)
+        decompressor = self.zstd.ZstdDecompressor(
+            dict_data=self._dict(dict_id))
+        return decompressor.decompress(blob, max_output_size=size)
+
+    def names(self):
+        """Returns (url, name) of every stored page"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT url, name FROM urls ORDER BY name").fetchall()
+
+    def stats(self):
+        """Returns stored pages, unique payloads, their size and the
+        compressed size in bytes"""
+        with self.lock:
+            pages = self.db.execute("SELECT count(*) FROM urls").fetchone()[0]
+            blobs, size, stored = self.db.execute(
+                "SELECT count(*), coalesce(sum(size), 0), "
+                "coalesce(sum(length), 0) FROM blobs").fetchone()
+        return {'pages': pages, 'payloads': blobs, 'bytes': size,
+                'stored_bytes': stored}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+@click.command()
+@click.option('--archive', 'path', help='Archive directory',
+              default='archive')
+@click.option('--url', help='Print the stored page of URL')
+@click.option('--extract', help='Extract all pages to directory')
+def main(path, url, extract):
+    """Read pages from a web-backup archive
+    """
+    archive = Archive(path)
+    if url:
+        content = archive.get(url)
+        if content is None:
+            raise click.ClickException(f"Not archived: {url}")
+        click.echo(content.decode('utf-8', 'replace'))
+    elif extract:
+        for page_url, name in archive.names():
+            filename = os.path.join(extract, name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(archive.get(page_url))
+            click.echo(filename)
+    else:
+        click.echo(archive.stats())
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import collections
+import sqlite3
+import time
+
+# A crawl task, headline is only set for articles
+Task = collections.namedtuple('Task', ['kind', 'url', 'year', 'month',
+                                       'headline'], defaults=[None])
+
+QUEUED = 'queued'
+INFLIGHT = 'inflight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Frontier:
+    """On-disk record of the crawl tasks of the current run
+
+    Every month listing, listing page and article URL of the run is
+    kept with its state (queued, inflight, done or failed), so an
+    interrupted run can be resumed. Changes are buffered and written
+    in one transaction every checkpoint changes or interval seconds,
+    a crash loses at most the changes since the last checkpoint,
+    whose tasks are then simply run again.
+
+    Only used from the thread scheduling the crawl.
+
+    Args:
+        path (string): SQLite database file, shared with the manifest
+        checkpoint (int, optional): Changes per checkpoint.
+            Defaults to 100.
+        interval (float, optional): Max seconds between checkpoints.
+            Defaults to 5.
+    """
+
+    def __init__(self, path, checkpoint=100, interval=5):
+        self.db = sqlite3.connect(path)
+        self.checkpoint_size = checkpoint
+        self.interval = interval
+        self.changes = []
+        self.last = time.monotonic()
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS frontier (
+                    url TEXT PRIMARY KEY,
+                    kind TEXT,
+                    year INTEGER,
+                    month INTEGER,
+                    headline TEXT,
+                    state TEXT,
+                    attempts INTEGER,
+                    updated_at REAL
+                )
+            """)
+
+    def reset(self):
+        """Forget the previous run"""
+        self.changes = []
+        with self.db:
+            self.db.execute("DELETE FROM frontier")
+
+    def load(self):
+        """Returns (task, state, attempts) of every task recorded by
+        the previous run, in-flight tasks did not finish and are
+        returned as queued"""
+        cur = self.db.execute(
+            "SELECT kind, url, year, month, headline, state, attempts "
+            "FROM frontier ORDER BY rowid")
+        return [(Task(*row[:5]), QUEUED if row[5] == INFLIGHT else row[5],
+                 row[6]) for row in cur]
+
+    def add(self, task):
+        """Record a new queued task"""
+        self.changes.append((
+            "INSERT OR REPLACE INTO frontier VALUES (?, ?, ?, ?, ?, ?, 0, ?)",
+            (task.url, task.kind, task.year, task.month, task.headline,
+             QUEUED, time.time())))
+
+    def update(self, url, state, attempts=None):
+        """Record the new state and, if given, failed attempts of a
+        task"""
+        self.changes.append((
+            "UPDATE frontier SET state = ?, "
+            "attempts = coalesce(?, attempts), updated_at = ? "
+            "WHERE url = ?", (state, attempts, time.time(), url)))
+
+    def checkpoint(self, force=False):
+        """Write the buffered changes if enough of them were collected
+        or enough time has passed
+
+        Args:
+            force (boolean, optional): Write them now. Defaults to False.
+        """
+        if not self.changes:
+            return
+        if (not force and len(self.changes) < self.checkpoint_size
+                and time.monotonic() - self.last < self.interval):
+            return
+        with self.db:
+            for sql, params in self.changes:
+                self.db.execute(sql, params)
+        self.changes = []
+        self.last = time.monotonic()
+
+    def close(self):
+        self.checkpoint(force=True)
+        self.db.close()
@@ -1,90 +1,391 @@
 #!/usr/bin/env python3
 import requests
+from requests.adapters import HTTPAdapter
 import click
-from bs4 import BeautifulSoup
+import collections
 import os
 import logging
 import datetime
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlsplit
+from archive import Archive
+from frontier import DONE, FAILED, INFLIGHT, QUEUED, Frontier, Task
+from manifest import Manifest
+from parsers import BACKENDS, get_backend
 
 
-def get_html(url, filename=None, year=None, month=None):
+class HostLimiter:
+    """Per host rate limit with a politeness delay
+
+    Requests to the same host start at most rate times per second,
+    each request additionally waits a random politeness delay of up
+    to delay seconds. A host answering 429/503 is paused for its
+    Retry-After time.
+
+    Args:
+        rate (float): Maximum requests per second per host
+        delay (float): Maximum random politeness delay in seconds
+    """
+
+    def __init__(self, rate, delay):
+        self.interval = 1 / rate
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def wait(self, url):
+        """Block until a request to the host of url may start"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = (start + self.interval
+                                + random.uniform(0, self.delay))
+        time.sleep(max(start - now, 0))
+
+    def pause(self, url, seconds):
+        """Do not start requests to the host of url for seconds"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._next[host] = max(self._next.get(host, 0),
+                                   time.monotonic() + seconds)
+
+
+def create_session(workers):
+    """Returns a requests session shared by all workers, with a
+    connection pool large enough for every worker
+
+    Args:
+        workers (int): Number of worker threads
+
+    Returns:
+        requests.Session: HTTP session
+    """
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_html(session, limiter, url, filename=None, year=None, month=None,
+             manifest=None, archive=None):
     """Returns HTML content from URL and saves it to
      file if filename is given
 
+    With a manifest, pages saved before are requested conditionally
+    (If-None-Match / If-Modified-Since) and the file is only written
+    when its content changed. With an archive the page is stored in it
+    instead of a file.
+
     Args:
+        session (requests.Session): Shared HTTP session
+        limiter (HostLimiter): Per host rate limit
         url (string): URL of the page
         filename (string, optional): File name. Defaults to None.
         year (string, optional): Year for directory. Defaults to None.
         month (string, optional): Month for directory. Defaults to None.
+        manifest (Manifest, optional): Backup manifest. Defaults to None.
+        archive (Archive, optional): Archive storage. Defaults to None.
 
     Returns:
-        _type_: _description_
+        tuple: HTML content (None if not modified) and URL of the page,
+            None on errors
     """
     try:
-        r = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
+        headers = {}
+        entry = manifest.get(url) if manifest and filename else None
+        if entry and (archive.contains(url) if archive
+                      else os.path.exists(entry[3])):
+            if entry[0]:
+                headers['If-None-Match'] = entry[0]
+            if entry[1]:
+                headers['If-Modified-Since'] = entry[1]
+        limiter.wait(url)
+        r = session.get(url, headers=headers)
+        if r.status_code == 304:
+            logging.info(f"Not modified: {url}")
+            return None, url
+        if r.status_code == 429 or r.status_code >= 500:
+            if r.status_code in (429, 503):
+                retry_after = r.headers.get('Retry-After', '')
+                limiter.pause(url, int(retry_after) if retry_after.isdigit()
+                              else 30)
+            logging.warning(f"Retryable error from {url}: {r.status_code}")
+            return None
 
         if filename:
             directory = f"{year}/{month}"
             publish_dir = os.path.join('html/', directory)
             filename = filename.replace("/", "")
-            if not os.path.exists(publish_dir):
-                os.makedirs(publish_dir)
             backup_file = f"{publish_dir}/{filename}.html"
-            logging.info(f"Creating file {backup_file}")
-            with open(backup_file, "wb") as f:
-                f.write(r.content)
-            logging.info(f"Backup complete for {url}")
-            f.close()
-            return r.content, url
-        else:
-            return r.content, url
+            sha256 = hashlib.sha256(r.content).hexdigest()
+            if archive:
+                backup_file = f"{directory}/{filename}.html"
+                if archive.put(url, r.content, backup_file, sha256):
+                    logging.info(f"Archived {url} as {backup_file}")
+                else:
+                    logging.info(f"Archived {url}, payload stored before")
+            elif (entry and entry[2] == sha256
+                    and os.path.exists(backup_file)):
+                logging.info(f"Unchanged: {backup_file}")
+            else:
+                logging.info(f"Creating file {backup_file}")
+                os.makedirs(publish_dir, exist_ok=True)
+                with open(backup_file, "wb") as f:
+                    f.write(r.content)
+                logging.info(f"Backup complete for {url}")
+            if manifest and r.ok:
+                manifest.update(url, r.headers.get('ETag'),
+                                r.headers.get('Last-Modified'), sha256,
+                                backup_file)
+        return r.content, url
     except requests.exceptions.RequestException as e:
         logging.error(f"Requests error: {e}")
         return None
 
 
-def get_data(html, url):
-    """Parse HTML content using BeautifulSoup
+def get_data(parser, html, url):
+    """Parse a listing page of a month
 
     Args:
-        html (list): Html content from get_html function
-        url (string): URL of the page
+        parser (object): Parsing backend, see parsers.get_backend
+        html (bytes): Html content of the listing page
+        url (string): URL of the month listing
+
+    Returns:
+        tuple: URLs of the other listing pages (page 2 onwards) and
+            (headline, URL) of every article on this page
     """
-    try:
-        # Get page numbers
-        soup = BeautifulSoup(html, "html.parser")
-        pages = soup.find_all(attrs={"class": "page-numbers"})
+    pages, content = parser.listing(html)
+
+    if pages:
+        max_pages = pages[1]
+    else:
+        # If there is only one page
+        max_pages = 1
+    logging.debug(f"Max pages: {max_pages}")
+
+    articles = []
+    for headline, furl in content:
+        if not furl:
+            logging.warning(f"Headline without URL: {headline}")
+            continue
+        print(headline, furl)
+        logging.info(f"Headline: {headline} | URL: {furl}")
+        articles.append((headline, furl))
+    return ([f"{url}page/{page}" for page in range(2, int(max_pages) + 1)],
+            articles)
+
+
+# Crawl tasks return the follow-up tasks they found, or None if the
+# page could not be fetched
+Context = collections.namedtuple(
+    'Context', ['session', 'limiter', 'manifest', 'parser', 'archive'])
+
+# Backoff of failed tasks: RETRY_DELAY doubled per attempt, at most
+# MAX_RETRY_DELAY seconds
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+def crawl_month(ctx, task):
+    """Fetch a month listing, returns tasks for its other listing pages
+    and for the articles on it (the month listing is page 1)"""
+    result = get_html(ctx.session, ctx.limiter, task.url)
+    if not result:
+        return None
+    pages, articles = get_data(ctx.parser, result[0], task.url)
+    return ([Task('page', page, task.year, task.month) for page in pages]
+            + [Task('article', furl, task.year, task.month, headline)
+               for headline, furl in articles])
+
+
+def crawl_page(ctx, task):
+    """Fetch a listing page, returns tasks for its articles"""
+    result = get_html(ctx.session, ctx.limiter, task.url)
+    if not result:
+        return None
+    _, articles = get_data(ctx.parser, result[0], task.url)
+    return [Task('article', furl, task.year, task.month, headline)
+            for headline, furl in articles]
+
+
+def crawl_article(ctx, task):
+    """Fetch an article and save it to html/<year>/<month>/ or the
+    archive"""
+    if not get_html(ctx.session, ctx.limiter, task.url, task.headline,
+                    task.year, task.month, ctx.manifest, ctx.archive):
+        return None
+    return []
+
+
+CRAWLERS = {
+    'month': crawl_month,
+    'page': crawl_page,
+    'article': crawl_article,
+}
+
+
+def month_over(year, month):
+    """Returns True if no more articles can be published in the month"""
+    now = datetime.datetime.now()
+    return (year, month) < (now.year, now.month)
+
+
+def retry_delay(attempts):
+    """Returns the backoff in seconds after the given failed attempts,
+    with jitter so retries of one host do not start together"""
+    delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+    return delay * random.uniform(0.5, 1)
 
-        month = url.split("/")[-2]
-        year = url.split("/")[-3]
 
-        if pages:
-            max_pages = pages[1].text
-            logging.debug(f"Max pages: {max_pages}")
+def crawl(site, months, workers, rate, delay, manifest, parser, frontier,
+          full=False, archive=None, resume=False, retries=3):
+    """Back up all articles of the given months concurrently
+
+    Month listings, listing pages and articles are fetched by a
+    bounded pool of worker threads sharing one HTTP session. Every
+    fetched page returns the follow-up tasks it found, which are
+    scheduled from here so workers never wait for each other. A URL
+    is fetched at most once per run, failed tasks are retried with
+    exponential backoff.
+
+    Every task is recorded in the frontier, with resume the tasks the
+    previous run did not finish are continued instead of starting
+    over.
+
+    Past months whose articles were all backed up are recorded in the
+    manifest and skipped by later runs, unless full is set.
+
+    Args:
+        site (string): Site URL
+        months (list): (year, month) tuples
+        workers (int): Number of worker threads
+        rate (float): Maximum requests per second per host
+        delay (float): Maximum random politeness delay in seconds
+        manifest (Manifest): Backup manifest
+        parser (object): Parsing backend, see parsers.get_backend
+        frontier (Frontier): Crawl frontier
+        full (boolean, optional): Crawl complete months again.
+            Defaults to False.
+        archive (Archive, optional): Store articles in the archive
+            instead of files. Defaults to None.
+        resume (boolean, optional): Continue the previous run.
+            Defaults to False.
+        retries (int, optional): Retries of a failed task. Defaults to 3.
+    """
+    session = create_session(workers)
+    ctx = Context(session, HostLimiter(rate, delay), manifest, parser,
+                  archive)
+    # Unfinished tasks and failures per month, URLs of the run
+    outstanding = collections.Counter()
+    failed = set()
+    seen = set()
+    # Failed tasks waiting for their retry: (time, sequence, task,
+    # attempts)
+    waiting = []
+    sequence = itertools.count()
+    pending = set()
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(task, attempts=0):
+        frontier.update(task.url, INFLIGHT)
+        future = executor.submit(CRAWLERS[task.kind], ctx, task)
+        future.task = task
+        future.attempts = attempts
+        pending.add(future)
+
+    def add(task, attempts=0, state=None):
+        """Schedule a task found in this run, or with state one
+        loaded from the frontier"""
+        if task.url in seen:
+            logging.debug(f"Already crawled in this run: {task.url}")
+            return
+        seen.add(task.url)
+        if state is None:
+            frontier.add(task)
+            state = QUEUED
+        if state == FAILED:
+            failed.add((task.year, task.month))
+        if state != QUEUED:
+            return
+        outstanding[task.year, task.month] += 1
+        submit(task, attempts)
+
+    def finish(month):
+        outstanding[month] -= 1
+        if (not outstanding[month] and month not in failed
+                and month_over(*month)):
+            logging.info(f"Month complete: {month}")
+            manifest.complete_month(site, *month)
+
+    try:
+        if resume:
+            for task, state, attempts in frontier.load():
+                add(task, attempts, state)
+            logging.info(f"Resuming {len(pending)} of {len(seen)} tasks")
         else:
-            # If there is only one page
-            max_pages = 1
-            logging.debug(f"Max pages: {max_pages}")
-
-        # Loop through all pages
-        for page in range(1, int(max_pages) + 1):
-            # Get HTML from page
-            html, url = get_html(f"{url}page/{page}")
-
-            # Parse HTML
-            soup = BeautifulSoup(html, "html.parser")
-            content = soup.find_all(attrs={"itemprop": "headline"})
-            # Get published date
-            # published_date = soup.find_all(attrs={"class": "published"})
-            # print(published_date)
-            for htm in content:
-                headline = htm.text
-                furl = htm.find("a").get("href")
-                print(headline, furl)
-                logging.info(f"Headline: {headline} | URL: {furl}")
-                get_html(furl, headline, year, month)
-    except Exception as e:
-        logging.error(f"Error in get_data function: {e}")
+            frontier.reset()
+        for year, month in months:
+            if not full and manifest.month_complete(site, year, month):
+                logging.info(f"Skipping complete month {year}/{month}")
+                continue
+            add(Task('month', f"{site}/{year}/{month}/", year, month))
+
+        while pending or waiting:
+            while waiting and waiting[0][0] <= time.monotonic():
+                _, _, task, attempts = heapq.heappop(waiting)
+                submit(task, attempts)
+            timeout = (max(waiting[0][0] - time.monotonic(), 0)
+                       if waiting else None)
+            if not pending:
+                time.sleep(timeout)
+                continue
+            done, _ = futures.wait(pending, timeout,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                task = future.task
+                month = (task.year, task.month)
+                try:
+                    tasks = future.result()
+                except Exception as e:
+                    logging.error(f"Error in crawl task: {e}")
+                    tasks = None
+                if tasks is None:
+                    attempts = future.attempts + 1
+                    if attempts <= retries:
+                        wait = retry_delay(attempts)
+                        logging.warning(f"Retrying {task.url} in "
+                                        f"{wait:.1f}s ({attempts}/{retries})")
+                        frontier.update(task.url, QUEUED, attempts)
+                        heapq.heappush(waiting, (time.monotonic() + wait,
+                                                 next(sequence), task,
+                                                 attempts))
+                        continue
+                    logging.error(f"Giving up on {task.url}")
+                    frontier.update(task.url, FAILED, attempts)
+                    failed.add(month)
+                else:
+                    for follow_up in tasks:
+                        add(follow_up)
+                    frontier.update(task.url, DONE)
+                finish(month)
+            frontier.checkpoint()
+    finally:
+        # Interrupted runs do not wait for queued tasks, the frontier
+        # keeps them for --resume
+        executor.shutdown(cancel_futures=True)
+        frontier.checkpoint(force=True)
+        session.close()
 
 
 @click.command()
@@ -92,29 +393,61 @@ def get_data(html, url):
 @click.option('--year', help='Enter year', type=int)
 @click.option('--month', help='Enter month', type=int)
 @click.option('--startyear', help='Enter start year', type=int, default=2010)
+@click.option('--workers', help='Number of download workers', type=int,
+              default=8)
+@click.option('--rate', help='Max requests per second per host',
+              type=float, default=4)
+@click.option('--delay', help='Max random politeness delay in seconds',
+              type=float, default=0.5)
+@click.option('--manifest', 'manifest_file', help='Backup manifest file',
+              default='manifest.sqlite')
+@click.option('--full', help='Crawl months already complete again',
+              is_flag=True)
+@click.option('--parser', help='HTML parser backend', default='auto',
+              type=click.Choice(['auto', *BACKENDS]))
+@click.option('--storage', help='Save articles as files or in an archive',
+              default='files', type=click.Choice(['files', 'archive']))
+@click.option('--archive', 'archive_dir', help='Archive directory',
+              default='archive')
+@click.option('--resume', help='Continue the previous run where it stopped',
+              is_flag=True)
+@click.option('--retries', help='Retries of a failed page', type=int,
+              default=3)
 @click.option('--debug', help='Enable debug logging', is_flag=True)
-def main(site, year, month, startyear, debug):
+def main(site, year, month, startyear, workers, rate, delay, manifest_file,
+         full, parser, storage, archive_dir, resume, retries, debug):
     """Main function
     """
     logging.basicConfig(level=logging.INFO if not debug else logging.DEBUG,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        format='%(asctime)s - %(threadName)s - '
+                               '%(levelname)s - %(message)s',
                         filename='main.log')
     try:
         if year and month:
-
             logging.debug(f"Fetching data for: {year}/{month}")
-            for date_year in range(year, year+1):
-                for date_month in range(month, month+1):
-                    content, url = get_html(f"{site}/{date_year}/{date_month}/")
-                    get_data(content, url)
+            months = [(year, month)]
         else:
             # get this year
             year = datetime.datetime.now().year
             logging.debug(f"Fetching data from {startyear} to {year}")
-            for date_year in range(startyear, year+1):
-                for date_month in range(1, 13):
-                    content, url = get_html(f"{site}/{date_year}/{date_month}/")
-                    get_data(content, url)
+            months = [(date_year, date_month)
+                      for date_year in range(startyear, year+1)
+                      for date_month in range(1, 13)]
+        manifest = Manifest(manifest_file)
+        parser = get_backend(parser)
+        logging.info(f"Parser backend: {parser.name}")
+        archive = Archive(archive_dir) if storage == 'archive' else None
+        frontier = Frontier(manifest_file)
+        try:
+            crawl(site, months, workers, rate, delay, manifest, parser,
+                  frontier, full, archive, resume, retries)
+        except KeyboardInterrupt:
+            logging.warning("Interrupted, continue with --resume")
+        frontier.close()
+        manifest.close()
+        if archive:
+            logging.info(f"Archive: {archive.stats()}")
+            archive.close()
 
     except Exception as e:
         logging.error(f"Error in main function: {e}")
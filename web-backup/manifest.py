@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+import time
+
+
+class Manifest:
+    """On-disk record of backed up pages and completed months
+
+    Stores the ETag, Last-Modified and SHA-256 of every saved page so
+    later runs can send conditional requests and skip unchanged files.
+    Shared by all worker threads.
+
+    Args:
+        path (string): SQLite database file
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    sha256 TEXT,
+                    file TEXT,
+                    fetched_at REAL
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS months (
+                    site TEXT,
+                    year INTEGER,
+                    month INTEGER,
+                    completed_at REAL,
+                    PRIMARY KEY (site, year, month)
+                )
+            """)
+
+    def get(self, url):
+        """Returns the manifest entry of url
+
+        Args:
+            url (string): Page URL
+
+        Returns:
+            sqlite3.Row: etag, last_modified, sha256, file or None
+        """
+        with self.lock:
+            cur = self.db.execute(
+                "SELECT etag, last_modified, sha256, file FROM pages "
+                "WHERE url = ?", (url,))
+            return cur.fetchone()
+
+    def update(self, url, etag, last_modified, sha256, file):
+        """Record a saved page
+
+        Args:
+            url (string): Page URL
+            etag (string): ETag response header
+            last_modified (string): Last-Modified response header
+            sha256 (string): SHA-256 of the content
+            file (string): Backup file location
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, sha256, file, time.time()))
+
+    def month_complete(self, site, year, month):
+        """Returns True if every article of the month was backed up"""
+        with self.lock:
+            cur = self.db.execute(
+                "SELECT 1 FROM months WHERE site = ? AND year = ? "
+                "AND month = ?", (site, year, month))
+            return cur.fetchone() is not None
+
+    def complete_month(self, site, year, month):
+        """Record that every article of the month was backed up"""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?)",
+                (site, year, month, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
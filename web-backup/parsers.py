@@ -0,0 +1,179 @@
+"""HTML parsing backends for listing pages
+
+Listing pages only need two things: the page-numbers pagination
+elements and the itemprop="headline" article links. Every backend
+extracts just those, the fastest installed one is used by default.
+"""
+import html.parser
+import logging
+import re
+
+
+def decode(html):
+    """Returns the page as str, bytes are decoded like BeautifulSoup
+    does: byte order mark, declared charset, detected encoding
+
+    Falls back to UTF-8 if BeautifulSoup is not installed.
+    """
+    if isinstance(html, str):
+        return html
+    try:
+        from bs4.dammit import UnicodeDammit
+    except ImportError:
+        return html.decode('utf-8', 'replace')
+    return UnicodeDammit(html, is_html=True).unicode_markup
+
+
+class Bs4Backend:
+    """BeautifulSoup with html.parser, building only the needed
+    elements"""
+    name = 'bs4'
+    # The strainer sees the whole class attribute, not single classes
+    page_class = re.compile(r"(^|\s)page-numbers(\s|$)")
+
+    def __init__(self):
+        from bs4 import BeautifulSoup, SoupStrainer
+        self.pages = SoupStrainer(attrs={"class": self.page_class})
+        self.headlines = SoupStrainer(attrs={"itemprop": "headline"})
+        self.soup = BeautifulSoup
+
+    def listing(self, html):
+        pages = self.soup(html, "html.parser", parse_only=self.pages)
+        headlines = self.soup(html, "html.parser", parse_only=self.headlines)
+        return (
+            [page.text for page in pages.find_all(
+                attrs={"class": "page-numbers"})],
+            [(htm.text, htm.a.get("href") if htm.a else None)
+             for htm in headlines.find_all(attrs={"itemprop": "headline"})]
+        )
+
+
+class LxmlBackend:
+    """lxml.html with XPath"""
+    name = 'lxml'
+
+    def __init__(self):
+        import lxml.html
+        self.fromstring = lxml.html.fromstring
+        # Without a charset declaration libxml2 assumes latin-1, pages
+        # are decoded first and handed over as UTF-8
+        self.parser = lxml.html.HTMLParser(encoding='utf-8')
+
+    def listing(self, html):
+        tree = self.fromstring(decode(html).encode('utf-8'),
+                               parser=self.parser)
+        pages = tree.xpath("//*[contains(concat(' ', normalize-space(@class),"
+                           " ' '), ' page-numbers ')]")
+        headlines = tree.xpath("//*[@itemprop='headline']")
+        return (
+            [page.text_content() for page in pages],
+            [(htm.text_content(), next(iter(htm.xpath(".//a/@href")), None))
+             for htm in headlines]
+        )
+
+
+class SelectolaxBackend:
+    """selectolax (lexbor) with CSS selectors"""
+    name = 'selectolax'
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self.parser = LexborHTMLParser
+
+    def listing(self, html):
+        # lexbor does not detect encodings of undeclared pages
+        tree = self.parser(decode(html))
+        headlines = []
+        for htm in tree.css('[itemprop="headline"]'):
+            link = htm.css_first("a")
+            headlines.append((htm.text(),
+                              link.attributes.get("href") if link else None))
+        return [page.text() for page in tree.css(".page-numbers")], headlines
+
+
+class _ListingExtractor(html.parser.HTMLParser):
+    """Collects the text and first link of page-numbers and headline
+    elements while the document is streamed, nothing else is kept
+
+    Matching elements can be nested (WordPress list pagination is an
+    ul.page-numbers of a.page-numbers), every one is collected in
+    document order and its text includes that of the nested ones.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.found = {'pages': [], 'headlines': []}
+        # Open matching elements: [tag, depth, [texts, href]]
+        self._open = []
+
+    def handle_starttag(self, tag, attrs):
+        for element in self._open:
+            if tag == element[0]:
+                element[1] += 1
+            if tag == 'a' and element[2][1] is None:
+                element[2][1] = dict(attrs).get('href')
+        attrs = dict(attrs)
+        if 'page-numbers' in (attrs.get('class') or '').split():
+            kind = 'pages'
+        elif attrs.get('itemprop') == 'headline':
+            kind = 'headlines'
+        else:
+            return
+        found = [[], None]
+        self.found[kind].append(found)
+        self._open.append([tag, 1, found])
+
+    def handle_endtag(self, tag):
+        for element in self._open:
+            if tag == element[0]:
+                element[1] -= 1
+        self._open = [element for element in self._open if element[1]]
+
+    def handle_data(self, data):
+        for element in self._open:
+            element[2][0].append(data)
+
+
+class StreamBackend:
+    """Standard library html.parser event stream, no tree is built"""
+    name = 'stream'
+
+    def listing(self, html):
+        extractor = _ListingExtractor()
+        extractor.feed(decode(html))
+        extractor.close()
+        return (
+            [''.join(text) for text, _ in extractor.found['pages']],
+            [(''.join(text), href)
+             for text, href in extractor.found['headlines']]
+        )
+
+
+BACKENDS = {
+    'selectolax': SelectolaxBackend,
+    'lxml': LxmlBackend,
+    'stream': StreamBackend,
+    'bs4': Bs4Backend,
+}
+
+
+def get_backend(name='auto'):
+    """Returns a parsing backend
+
+    Args:
+        name (string, optional): Backend name or 'auto' for the fastest
+            installed one (selectolax, lxml, stream). Defaults to 'auto'.
+
+    Returns:
+        object: Backend whose listing(html) returns the page-numbers
+            texts and the (headline, URL) of every article, URL is None
+            for a headline without a link
+    """
+    if name != 'auto':
+        return BACKENDS[name]()
+    for backend in ('selectolax', 'lxml'):
+        try:
+            return BACKENDS[backend]()
+        except ImportError:
+            logging.debug(f"Parser backend {backend} not installed")
+    return StreamBackend()
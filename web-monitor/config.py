@@ -1,22 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import threading
 
-from dynaconf import Dynaconf, Validator
+SETTINGS_FILES = ['settings.yaml', '.secrets.yaml']
+# Loaded by Dynaconf on its own, see dynaconf_validators.toml
+VALIDATORS_FILE = 'dynaconf_validators.toml'
+# Validated settings of the last run, empty to always validate
+CACHE_FILE = os.environ.get('WEB_MONITOR_SETTINGS_CACHE',
+                            '.settings.cache.json')
+# Settings with these words in their name are never cached
+SECRET_WORDS = ('password', 'secret', 'token')
 
-settings = Dynaconf(
-    envvar_prefix="DYNACONF",
-    environments=True,
-    settings_files=['settings.yaml', '.secrets.yaml'],
-    validators=[
-        Validator('enabled_web_urls', 'kafka_bootstrap_servers',
-                  'kafka_security_protocol', 'kafka_ssl_certfile',
-                  'kafka_ssl_keyfile', 'kafka_ssl_cafile', 'kafka_topic',
-                  'postgres_host', 'postgres_port', 'postgres_user',
-                  'postgres_dbname', 'postgres_sslmode',
-                  'postgres_ssl_cafile', 'postgres_password', must_exist=True),
-        Validator('web_regex', must_exist=None)
-    ]
 
+def is_secret(name):
+    return any(word in name.lower() for word in SECRET_WORDS)
 
-)
 
-# `envvar_prefix` = export envvars with `export DYNACONF_FOO=bar`.
-# `settings_files` = Load these files in the order.
+def create_dynaconf(validate=True):
+    """Returns the Dynaconf settings with their validators, validated
+    on first use unless validate is False"""
+    from dynaconf import Dynaconf, Validator
+
+    return Dynaconf(
+        envvar_prefix="DYNACONF",
+        environments=True,
+        settings_files=SETTINGS_FILES,
+        dynaconf_skip_validators=not validate,
+        validators=[
+            Validator('enabled_web_urls', 'kafka_bootstrap_servers',
+                      'kafka_security_protocol', 'kafka_ssl_certfile',
+                      'kafka_ssl_keyfile', 'kafka_ssl_cafile', 'kafka_topic',
+                      'postgres_host', 'postgres_port', 'postgres_user',
+                      'postgres_dbname', 'postgres_sslmode',
+                      'postgres_ssl_cafile', 'postgres_password',
+                      must_exist=True),
+            Validator('web_regex', must_exist=None),
+            # Probe engine tuning, see probe.py
+            Validator('probe_concurrency', default=100, gte=1),
+            Validator('probe_limit_per_host', default=4, gte=0),
+            Validator('probe_timeout', default=10, gt=0),
+            Validator('probe_keepalive', default=30, gt=0),
+            Validator('web_url_regex', default={}),
+            Validator('web_body_limit', default=1048576, gt=0),
+            Validator('web_regex_overlap', default=1024, gt=0),
+            # Scheduled producer, see scheduler.py
+            Validator('check_interval', default=60, gt=0),
+            Validator('check_jitter', default=0.1, gte=0, lt=1),
+            Validator('web_url_intervals', default={}),
+            # Producer batching, see producer.py
+            Validator('kafka_linger_ms', default=50, gte=0),
+            Validator('kafka_batch_size', default=65536, gte=0),
+            Validator('kafka_compression_type', default=None,
+                      is_in=[None, 'gzip', 'snappy', 'lz4', 'zstd']),
+            Validator('kafka_stats_interval', default=60, gt=0),
+            # Spool of messages while Kafka is unreachable, see spool.py
+            Validator('spool_dir', default='spool'),
+            Validator('spool_segment_bytes', default=4194304, gt=0),
+            Validator('spool_max_bytes', default=268435456, gt=0),
+            Validator('spool_replay_batch', default=500, gte=1),
+            Validator('spool_replay_interval', default=10, gt=0),
+            # Consumer micro-batching, see consumer.py
+            Validator('kafka_group_id', default='web-monitor'),
+            Validator('consumer_batch_size', default=500, gte=1),
+            Validator('consumer_batch_timeout_ms', default=1000, gt=0),
+            Validator('consumer_max_pending_batches', default=4, gte=1),
+            Validator('consumer_retry_max_delay', default=60, gt=0),
+            # Events partitions and rollups, see schema.py
+            Validator('events_partition_days_ahead', default=3, gte=0),
+            Validator('rollup_lag_minutes', default=10, gte=0),
+            # Prometheus metrics endpoint, see metrics.py
+            Validator('metrics_port', default=0, gte=0),
+            Validator('metrics_addr', default='127.0.0.1')
+        ]
+    )
+    # `envvar_prefix` = export envvars with `export DYNACONF_FOO=bar`.
+    # `settings_files` = Load these files in the order.
+
+
+def __getattr__(name):
+    # The Dynaconf settings for the dynaconf CLI, only created on use:
+    # dynaconf -i config.dynaconf list
+    if name == 'dynaconf':
+        return create_dynaconf()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def sources_key():
+    """Returns a digest of everything the validated settings depend on:
+    the settings files, the validators and the DYNACONF environment
+    variables
+
+    Of secret environment variables only whether they are empty is
+    included, their values are not cached and stay out of the cache
+    file.
+    """
+    sources = []
+    for path in [*SETTINGS_FILES, VALIDATORS_FILE, __file__]:
+        try:
+            stat = os.stat(path)
+            sources.append([os.path.abspath(path), stat.st_mtime_ns,
+                            stat.st_size])
+        except OSError:
+            sources.append([path, None, None])
+    sources.append(sorted((name, bool(value) if is_secret(name) else value)
+                          for name, value in os.environ.items()
+                          if 'DYNACONF' in name))
+    return hashlib.sha256(json.dumps(sources).encode()).hexdigest()
+
+
+def load(cache_file=CACHE_FILE):
+    """Returns the validated settings, from the cache if none of their
+    sources changed since they were validated
+
+    Secret settings (see is_secret) are validated but not cached, they
+    are read by Settings on use. The cache is only readable by its
+    owner all the same.
+
+    Args:
+        cache_file (string, optional): Cache file, empty to always
+            validate. Defaults to CACHE_FILE.
+
+    Returns:
+        dict: Settings without secrets, upper case keys
+    """
+    key = sources_key()
+    if cache_file:
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached['key'] == key:
+                return cached['settings']
+        except (OSError, ValueError, KeyError):
+            pass
+    values = {name: value
+              for name, value in create_dynaconf().as_dict().items()
+              if not is_secret(name)}
+    if cache_file:
+        try:
+            tmp = f'{cache_file}.{os.getpid()}.tmp'
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'settings': values}, f)
+            os.replace(tmp, cache_file)
+        except OSError as e:
+            logging.debug(f"Settings cache not written: {e}")
+    return values
+
+
+class Settings:
+    """Settings loaded on first use, read like Dynaconf settings
+    (settings.kafka_topic, settings.get('web_regex'))
+
+    Validating with Dynaconf is only needed when the settings files or
+    environment changed, see load. Secrets are read from Dynaconf,
+    without validating again, on their first use.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._secrets = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._values is None:
+                self._values = {name.lower(): value
+                                for name, value in load().items()}
+        return self._values
+
+    def _secret(self, name, default):
+        # Secrets were validated with the other settings by load
+        self._load()
+        with self._lock:
+            if self._secrets is None:
+                self._secrets = create_dynaconf(validate=False)
+        return self._secrets.get(name, default)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            if is_secret(name):
+                value = self._secret(name, None)
+                if value is None:
+                    raise KeyError(name)
+                return value
+            return self._load()[name.lower()]
+        except KeyError:
+            raise AttributeError(f"Setting not found: {name}") from None
+
+    def get(self, name, default=None):
+        if is_secret(name):
+            return self._secret(name, default)
+        return self._load().get(name.lower(), default)
+
+
+settings = Settings()
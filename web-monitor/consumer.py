@@ -0,0 +1,565 @@
+import collections
+import json
+import logging
+import multiprocessing
+import random
+import signal
+import threading
+import time
+import kafka
+import psycopg2
+import psycopg2.extras
+from kafka.structs import OffsetAndMetadata, TopicPartition
+import metrics
+from config import settings
+from schema import connect_postgres, ensure_partitions, prepare_database
+
+EVENT_COLUMNS = ('url', 'status_code', 'response_time',
+                 'response_body_regex', 'checked_at', 'dns_time',
+                 'connect_time', 'tls_time', 'ttfb_time', 'download_time')
+# Messages from older producers have no checked_at
+EVENT_TEMPLATE = ('(%s, %s, %s, %s, coalesce(%s::timestamptz, now()), '
+                  '%s, %s, %s, %s, %s)')
+# Poll interval while fetching is paused, see EventBatcher
+PAUSED_POLL_MS = 100
+# Maximum seconds to wait for Postgres on rebalance and shutdown
+DRAIN_TIMEOUT = 30
+# Seconds between checks for upcoming events partitions, see EventWriter
+PARTITIONS_INTERVAL = 3600
+
+
+def create_consumer():
+    """Create Kafka consumer from settings
+
+    The consumer joins the kafka_group_id consumer group. Offsets are
+    committed manually, only after the events have been stored in
+    Postgres.
+
+    Returns:
+        kafka.KafkaConsumer: Kafka consumer with JSON deserializer
+    """
+    return kafka.KafkaConsumer(
+        bootstrap_servers=settings.kafka_bootstrap_servers,
+        security_protocol=settings.kafka_security_protocol,
+        ssl_certfile=settings.kafka_ssl_certfile,
+        ssl_keyfile=settings.kafka_ssl_keyfile,
+        ssl_cafile=settings.kafka_ssl_cafile,
+        group_id=settings.kafka_group_id,
+        enable_auto_commit=False,
+        auto_offset_reset='earliest',
+        value_deserializer=lambda m: json.loads(m.decode('ascii'))
+    )
+
+
+def insert_events(pgconn, events):
+    """Insert events with one multi-row INSERT and commit
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+        events (list): Kafka message values
+    """
+    rows = [tuple(event.get(column) for column in EVENT_COLUMNS)
+            for event in events]
+    try:
+        with pgconn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO events ({', '.join(EVENT_COLUMNS)}) VALUES %s",
+                rows,
+                template=EVENT_TEMPLATE,
+                page_size=len(rows)
+            )
+        pgconn.commit()
+    except psycopg2.Error:
+        # Nothing to roll back on a lost connection
+        if not pgconn.closed:
+            pgconn.rollback()
+        raise
+
+
+class EventWriter(threading.Thread):
+    """Writes batches of events to Postgres in a background thread
+
+    Batches are written in the order they were submitted. A failed
+    write is retried, reconnecting after connection errors, with
+    exponential backoff of up to consumer_retry_max_delay seconds until
+    it succeeds, so a Postgres outage, failover or missing privilege
+    loses no events. Only a batch failing with a row level error
+    (DataError, IntegrityError) is inserted event by event instead: the
+    events failing with a row level error again are logged with their
+    content and skipped, the batch counts as stored. At most
+    max_pending batches wait to be written.
+
+    Every PARTITIONS_INTERVAL seconds the upcoming daily events
+    partitions are created, a consumer running for longer than
+    events_partition_days_ahead would otherwise write into
+    events_default.
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+        max_pending (int, optional): Batches waiting to be written
+        retry_max_delay (float, optional): Maximum seconds between
+            retries
+        connect (callable, optional): Returns a new Postgres connection.
+            Defaults to connect_postgres.
+    """
+
+    def __init__(self, pgconn, max_pending=None, retry_max_delay=None,
+                 connect=connect_postgres):
+        super().__init__(name='postgres-writer', daemon=True)
+        self.pgconn = pgconn
+        self.connect = connect
+        self.max_pending = (max_pending
+                            or settings.consumer_max_pending_batches)
+        self.retry_max_delay = (retry_max_delay
+                                or settings.consumer_retry_max_delay)
+        self._pending = collections.deque()
+        # Kafka offsets of the stored batches, in order
+        self._stored = collections.deque()
+        self._cond = threading.Condition()
+        self._closing = threading.Event()
+        # Partitions were created when the consumer started
+        self._partitions_at = time.monotonic() + PARTITIONS_INTERVAL
+
+    def submit(self, events, offsets):
+        """Queue a batch unless max_pending batches are waiting
+
+        Args:
+            events (list): Kafka message values
+            offsets (dict): Offsets to commit once the batch is stored
+
+        Returns:
+            boolean: The batch was queued
+        """
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                return False
+            self._pending.append((events, offsets))
+            metrics.CONSUMER_PENDING_BATCHES.set(len(self._pending))
+            self._cond.notify_all()
+        return True
+
+    def stored(self):
+        """Returns the offsets of the batches stored since the last call,
+        merged"""
+        offsets = {}
+        with self._cond:
+            while self._stored:
+                offsets.update(self._stored.popleft())
+        return offsets
+
+    def wait_idle(self, timeout):
+        """Wait until all queued batches are stored
+
+        Returns:
+            boolean: All batches were stored within timeout seconds
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending or self._closing.is_set())
+                if not self._pending:
+                    return
+                events, offsets = self._pending[0]
+            if not self.write(events):
+                return
+            self.maintain()
+            with self._cond:
+                self._pending.popleft()
+                self._stored.append(offsets)
+                metrics.CONSUMER_PENDING_BATCHES.set(len(self._pending))
+                self._cond.notify_all()
+
+    def write(self, events):
+        """Write one batch, retrying until it is stored
+
+        Returns:
+            boolean: False if the writer was closed while retrying
+        """
+        attempts = 0
+        # Events left to insert one by one once the batch was rejected
+        single = None
+        while True:
+            start = time.monotonic()
+            try:
+                if self.pgconn is None:
+                    self.pgconn = self.connect()
+                if single is not None:
+                    self.insert_each(single)
+                    return True
+                insert_events(self.pgconn, events)
+                seconds = time.monotonic() - start
+                metrics.CONSUMED.inc(len(events))
+                metrics.CONSUMER_BATCH_SECONDS.observe(seconds)
+                logging.info(f"Events sent to Postgres: {len(events)} in "
+                             f"{seconds:.3f}s")
+                return True
+            except psycopg2.Error as e:
+                if single is None and self._rejected(e):
+                    logging.error(f"Postgres rejected a batch of "
+                                  f"{len(events)} events, inserting them "
+                                  f"one by one: {e}")
+                    single = collections.deque(events)
+                    continue
+                attempts += 1
+                delay = (min(2 ** (attempts - 1), self.retry_max_delay)
+                         * random.uniform(0.5, 1))
+                logging.error(f"Postgres write of {len(events)} events "
+                              f"failed, retry {attempts} in {delay:.1f}s: "
+                              f"{e}")
+                if self.pgconn is not None and (
+                        self.pgconn.closed
+                        or isinstance(e, (psycopg2.OperationalError,
+                                          psycopg2.InterfaceError))):
+                    self._disconnect()
+                if self._closing.wait(delay):
+                    return False
+
+    def insert_each(self, events):
+        """Insert events one by one, each in its own transaction, and
+        remove them from the events deque
+
+        Events failing with a row level error are logged and skipped,
+        other errors are raised with the remaining events left in the
+        deque.
+        """
+        while events:
+            try:
+                insert_events(self.pgconn, [events[0]])
+                metrics.CONSUMED.inc()
+            except psycopg2.Error as e:
+                if not self._rejected(e):
+                    raise
+                metrics.CONSUMER_REJECTED.inc()
+                logging.error(f"Postgres rejected event, skipping it: "
+                              f"{json.dumps(events[0])}: {e}")
+            events.popleft()
+
+    def _rejected(self, e):
+        """Returns True if e is an error of the inserted rows, any other
+        error (connection, failover to a read-only standby, privileges,
+        schema) fails every row alike"""
+        return (self.pgconn is not None and not self.pgconn.closed
+                and isinstance(e, (psycopg2.DataError,
+                                   psycopg2.IntegrityError)))
+
+    def maintain(self):
+        """Create upcoming events partitions every PARTITIONS_INTERVAL
+        seconds, errors are logged and retried at the next interval"""
+        if time.monotonic() < self._partitions_at:
+            return
+        self._partitions_at = time.monotonic() + PARTITIONS_INTERVAL
+        try:
+            ensure_partitions(self.pgconn)
+        except psycopg2.Error as e:
+            logging.error(f"Creating events partitions failed: {e}")
+            if not self.pgconn.closed:
+                self.pgconn.rollback()
+
+    def _disconnect(self):
+        try:
+            self.pgconn.close()
+        except psycopg2.Error:
+            pass
+        self.pgconn = None
+
+    def close(self, timeout):
+        """Stop after the queued batches are stored, or after timeout
+        seconds, and close the Postgres connection
+
+        Returns:
+            boolean: All queued batches were stored
+        """
+        stored = self.wait_idle(timeout)
+        self._closing.set()
+        with self._cond:
+            self._cond.notify_all()
+        self.join(timeout)
+        if not self.is_alive() and self.pgconn is not None:
+            self._disconnect()
+        return stored
+
+
+class EventBatcher:
+    """Micro-batches Kafka messages into Postgres transactions
+
+    A batch is handed to the EventWriter when it holds
+    consumer_batch_size messages or its first message is
+    consumer_batch_timeout_ms old. Kafka offsets are committed only
+    after the writer stored the batch, so every message is stored at
+    least once.
+
+    Backpressure: while Postgres is slow or down the writer queue
+    fills up. A due batch that does not fit into the queue is kept and
+    fetching is paused for all assigned partitions until it does, the
+    consumer keeps polling so it stays in the consumer group. At most
+    consumer_max_pending_batches + 1 batches are held in memory.
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+        consumer (kafka.KafkaConsumer): Kafka consumer
+        batch_size (int, optional): Messages per batch
+        batch_timeout_ms (int, optional): Maximum age of a batch
+        max_pending (int, optional): Batches waiting to be written
+        connect (callable, optional): Returns a new Postgres connection.
+            Defaults to connect_postgres.
+    """
+
+    def __init__(self, pgconn, consumer, batch_size=None,
+                 batch_timeout_ms=None, max_pending=None,
+                 connect=connect_postgres):
+        self.consumer = consumer
+        self.batch_size = batch_size or settings.consumer_batch_size
+        self.batch_timeout = (batch_timeout_ms
+                              or settings.consumer_batch_timeout_ms) / 1000
+        self.writer = EventWriter(pgconn, max_pending, connect=connect)
+        self.writer.start()
+        self.events = []
+        self.offsets = {}
+        self.started = None
+        self.paused = False
+
+    def add(self, message):
+        """Add a Kafka message to the batch"""
+        if not self.events:
+            self.started = time.monotonic()
+        logging.debug(f"Message: {message.value}")
+        self.events.append(message.value)
+        self.offsets[TopicPartition(message.topic, message.partition)] = \
+            OffsetAndMetadata(message.offset + 1, None)
+
+    def room(self):
+        """Number of messages that still fit into the batch, at least 1
+        as poll() needs a positive max_records"""
+        return max(self.batch_size - len(self.events), 1)
+
+    def remaining_ms(self):
+        """Milliseconds until the batch has to be written"""
+        if self.paused:
+            return PAUSED_POLL_MS
+        if not self.events:
+            return int(self.batch_timeout * 1000)
+        left = self.started + self.batch_timeout - time.monotonic()
+        return max(int(left * 1000), 0)
+
+    def due(self):
+        return bool(self.events) and (
+            len(self.events) >= self.batch_size
+            or time.monotonic() - self.started >= self.batch_timeout)
+
+    def flush(self):
+        """Hand the batch to the writer
+
+        Returns:
+            boolean: False if the writer queue is full
+        """
+        if not self.events:
+            return True
+        if not self.writer.submit(self.events, self.offsets):
+            return False
+        self.events = []
+        self.offsets = {}
+        self.started = None
+        return True
+
+    def commit(self):
+        """Commit the Kafka offsets of the stored batches, of the
+        partitions still assigned to this consumer"""
+        assigned = self.consumer.assignment()
+        offsets = {tp: offset for tp, offset in self.writer.stored().items()
+                   if tp in assigned}
+        if offsets:
+            self.consumer.commit(offsets)
+
+    def backpressure(self):
+        """Hand a due batch to the writer, pause fetching while it does
+        not fit and resume once it did"""
+        if self.due() and not self.flush():
+            if not self.paused:
+                logging.warning("Postgres is behind, pausing consumption")
+                self.paused = True
+                metrics.CONSUMER_PAUSED.set(1)
+            # Also pauses partitions assigned since
+            self.consumer.pause(*self.consumer.assignment())
+        elif self.paused:
+            logging.info("Postgres caught up, resuming consumption")
+            self.consumer.resume(*self.consumer.paused())
+            self.paused = False
+            metrics.CONSUMER_PAUSED.set(0)
+
+    def drain(self, timeout):
+        """Write the batch and all queued batches and commit their
+        offsets
+
+        Args:
+            timeout (float): Maximum seconds to wait for Postgres
+
+        Returns:
+            boolean: Everything was stored within timeout
+        """
+        deadline = time.monotonic() + timeout
+        while not self.flush():
+            if time.monotonic() >= deadline:
+                break
+            self.writer.wait_idle(PAUSED_POLL_MS / 1000)
+        stored = self.writer.wait_idle(max(deadline - time.monotonic(), 0))
+        self.commit()
+        return stored and not self.events
+
+    def discard(self):
+        """Drop the batch without committing its offsets"""
+        self.events = []
+        self.offsets = {}
+        self.started = None
+
+    def close(self, timeout):
+        """Stop the writer after it stored the queued batches, or after
+        timeout seconds
+
+        Returns:
+            boolean: All queued batches were stored
+        """
+        return self.writer.close(timeout)
+
+
+class RebalanceListener(kafka.ConsumerRebalanceListener):
+    """Writes the current batch before partitions move to another
+    consumer of the group
+
+    Args:
+        batcher (EventBatcher): Batch of the consumer
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    def on_partitions_revoked(self, revoked):
+        logging.info(f"Partitions revoked: {sorted(revoked)}")
+        try:
+            if self.batcher.drain(DRAIN_TIMEOUT):
+                return
+            logging.error("Postgres did not catch up before the rebalance")
+        except Exception as e:
+            logging.error(f"Flush on rebalance failed: {e}")
+        # Offsets are not committed, the new owner of the partitions
+        # consumes these events again
+        self.batcher.discard()
+
+    def on_partitions_assigned(self, assigned):
+        logging.info(f"Partitions assigned: {sorted(assigned)}")
+        if not assigned:
+            logging.warning("No partitions assigned, more workers than "
+                            "topic partitions")
+
+
+def consume(consumer, batcher, stopping):
+    """Consume messages into batches until stopping is true
+
+    Args:
+        consumer (kafka.KafkaConsumer): Subscribed Kafka consumer
+        batcher (EventBatcher): Batch of the consumer
+        stopping (object): Checked for truth after every poll
+    """
+    while not stopping:
+        records = consumer.poll(timeout_ms=batcher.remaining_ms(),
+                                max_records=batcher.room())
+        for messages in records.values():
+            for message in messages:
+                batcher.add(message)
+        batcher.commit()
+        batcher.backpressure()
+    if not batcher.drain(DRAIN_TIMEOUT):
+        logging.error("Postgres did not catch up, uncommitted events are "
+                      "consumed again by the next run")
+    batcher.close(DRAIN_TIMEOUT)
+
+
+def consume_events(topic, prepare=True):
+    """Consume messages from Kafka topic
+    and send events to Postgres database in batches until
+    SIGINT/SIGTERM
+
+    Args:
+        topic (string): Kafka topic name
+        prepare (boolean, optional): Prepare the database schema first.
+            Defaults to True.
+    """
+    stopping = []
+
+    def stop(signum, frame):
+        logging.info("Consumer stopping")
+        stopping.append(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        pgconn = connect_postgres()
+        if prepare:
+            prepare_database(pgconn)
+        consumer = create_consumer()
+        batcher = EventBatcher(pgconn, consumer)
+        consumer.subscribe(topics=[topic],
+                           listener=RebalanceListener(batcher))
+        consume(consumer, batcher, stopping)
+        consumer.close()
+
+    except kafka.errors.NoBrokersAvailable:
+        logging.error("Kafka NoBrokersAvailable")
+    except kafka.errors.KafkaError as e:
+        logging.error(f"KafkaError: {e}")
+    except (Exception, psycopg2.Error) as error:
+        logging.error(error)
+
+
+def _worker(topic, level, index):
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s')
+    metrics.start_metrics(offset=index)
+    consume_events(topic, prepare=False)
+
+
+def run_workers(topic, workers):
+    """Consume messages with several processes of one consumer group
+
+    Every worker has its own Kafka consumer and Postgres connection.
+    Kafka spreads the topic partitions over the workers, so more
+    workers than topic partitions leaves workers idle.
+
+    Args:
+        topic (string): Kafka topic name
+        workers (int): Number of worker processes
+    """
+    try:
+        pgconn = connect_postgres()
+        prepare_database(pgconn)
+        pgconn.close()
+    except psycopg2.Error as error:
+        logging.error(error)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    # Workers handle SIGINT/SIGTERM themselves and stop cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    processes = [
+        ctx.Process(target=_worker, name=f"consumer-{i}",
+                    args=(topic, logging.getLogger().level, i))
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Started {workers} consumer workers")
+
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    for process in processes:
+        process.join()
+        logging.info(f"{process.name} exited: {process.exitcode}")
@@ -1,176 +1,131 @@
 #!/usr/bin/env python
-import psycopg2
-import kafka
-import requests
 import logging
-import re
 import click
 from config import settings
-import json
 
+# Every mode imports the modules it needs when it starts, so a mode
+# does not pay for the imports (Kafka, aiohttp, psycopg2) of the others
 
-def webchecker(url):
-    """Check website status for collecting website
-    status code, response time and response body
 
-    Args:
-        url (string): Website URL
+def kafka_producer(topic, enabled_web_urls):
+    """Send messages to Kafka topic
 
-    Returns:
-        status_code (string): HTTP request status code
-        response_time (string): Response time in seconds
-        response_body_regex (boolean): Response body regex match status
+    Messages spooled while Kafka was unreachable are sent first. If
+    Kafka is unreachable the messages of this run are spooled.
+
+    Args:
+        topic (string): Kafka topic name
+        enabled_web_urls (list): list of enabled website URLs
     """
+    from probe import probe_urls
+    from producer import DeliveryStats, Publisher, create_spool
     try:
-        req = requests.get(url)
-        status_code = req.status_code
-        response_time = req.elapsed.total_seconds()
-        response_body = req.content.decode('latin-1')
-
-        logging.info(f"Website {url} code: {status_code}")
-        logging.info(f"Website {url} response time: {response_time}")
 
-        # Check if response_body matches the expected regex
-        # defined in settings.yml
-        try:
-            response_body_regex = re.search(settings.web_regex, response_body)
-            logging.debug(f"Website {url} regex status: {response_body_regex}")
-            return status_code, response_time, response_body_regex is not None
+        stats = DeliveryStats()
+        publisher = Publisher(topic, create_spool(), stats)
+        publisher.replay()
+        # Monitor website X status, all websites are checked concurrently
+        for message in probe_urls(enabled_web_urls):
+            publisher.publish(message)
+        # Messages are sent in batches, wait for the whole cycle once
+        publisher.flush()
+        stats.report()
+        publisher.close()
+    except Exception as e:
+        logging.error(f"Kafka producer function error: {e}")
 
-        except AttributeError:
-            return status_code, response_time, None
 
-    except requests.exceptions.RequestException as e:
-        logging.error(e)
-        return None, None, None
+def scheduled_producer(topic, enabled_web_urls):
+    """Keep checking websites on their intervals and send messages
+    to Kafka topic until SIGINT/SIGTERM
 
-
-def kafka_producer(topic, enabled_web_urls):
-    """Send messages to Kafka topic
+    The Kafka producer and the HTTP connection pool are created once
+    and reused for every check. Messages are sent in producer batches
+    and delivery statistics are logged every kafka_stats_interval.
+    While Kafka is unreachable messages are spooled, they are sent
+    again every spool_replay_interval.
 
     Args:
         topic (string): Kafka topic name
         enabled_web_urls (list): list of enabled website URLs
     """
+    import asyncio
+    from producer import DeliveryStats, Publisher, create_spool
+    from scheduler import run_scheduler
     try:
-
-        producer = kafka.KafkaProducer(
-            bootstrap_servers=settings.kafka_bootstrap_servers,
-            security_protocol=settings.kafka_security_protocol,
-            ssl_certfile=settings.kafka_ssl_certfile,
-            ssl_keyfile=settings.kafka_ssl_keyfile,
-            ssl_cafile=settings.kafka_ssl_cafile,
-            value_serializer=lambda m: json.dumps(m).encode('ascii')
-        )
-        # Monitor website X status
-        for url in enabled_web_urls:
-            status_code, response_time, response_body_regex = webchecker(
-                url)
-            message = {
-                'url': url,
-                'status_code': status_code,
-                'response_time': response_time,
-                'response_body_regex': response_body_regex
-            }
-            producer.send(topic, message)
-            producer.flush()
-    except kafka.errors.NoBrokersAvailable:
-        logging.error("Kafka NoBrokersAvailable")
-    except kafka.errors.KafkaError as e:
-        logging.error(f"KafkaError: {e}")
+        stats = DeliveryStats()
+        publisher = Publisher(topic, create_spool(), stats)
+        asyncio.run(run_scheduler(enabled_web_urls, publisher.publish,
+                                  stats.report, publisher.replay))
+        # Shutdown: deliver what is still waiting in producer batches
+        publisher.flush()
+        stats.report()
+        publisher.close()
     except Exception as e:
-        logging.error(f"Kafka producer function error: {e}")
+        logging.error(f"Kafka scheduled producer function error: {e}")
 
 
-def consume_events(topic):
-    """Consume messages from Kafka topic
-    and send events to Postgres database
+def maintain_database(update_rollups):
+    """Apply schema migrations, create upcoming events partitions
+    and optionally update the rollup tables
 
     Args:
-        topic (string): Kafka topic name
+        update_rollups (boolean): Update per minute/hour rollups
     """
+    from schema import connect_postgres, prepare_database, rollup
     try:
-        pgconn = psycopg2.connect(
-            host=settings.postgres_host,
-            port=settings.postgres_port,
-            user=settings.postgres_user,
-            password=settings.postgres_password,
-            database=settings.postgres_dbname,
-            sslmode=settings.postgres_sslmode,
-            sslrootcert=settings.postgres_ssl_cafile
-        )
-
-        events_table_sql = """
-                CREATE TABLE IF NOT EXISTS events (
-                    id SERIAL PRIMARY KEY,
-                    url TEXT,
-                    status_code INTEGER,
-                    response_time REAL,
-                    response_body_regex BOOLEAN
-                )
-            """
-        # Create Postgres events table if not exists
-        with pgconn.cursor() as cur_table:
-            cur_table.execute(events_table_sql)
-            pgconn.commit()
-            cur_table.close()
-
-        consumer = kafka.KafkaConsumer(
-            topic,
-            bootstrap_servers=settings.kafka_bootstrap_servers,
-            security_protocol=settings.kafka_security_protocol,
-            ssl_certfile=settings.kafka_ssl_certfile,
-            ssl_keyfile=settings.kafka_ssl_keyfile,
-            ssl_cafile=settings.kafka_ssl_cafile,
-            value_deserializer=lambda m: json.loads(m.decode('ascii'))
-        )
-
-        for message in consumer:
-            logging.debug(f"Message: {message.value}")
-
-            url = message.value['url']
-            status_code = message.value['status_code']
-            response_time = message.value['response_time']
-            response_body_regex = message.value['response_body_regex']
-
-            cur = pgconn.cursor()
-            cur.execute(
-                "INSERT INTO events (url, status_code, response_time, response_body_regex) VALUES (%s, %s, %s, %s)",
-                (url, status_code, response_time, response_body_regex)
-            )
-            logging.info(
-                f"Event sent to Postgres: {url} {status_code} {response_time} {response_body_regex}")
-            pgconn.commit()
-            cur.close()
+        pgconn = connect_postgres()
+        prepare_database(pgconn)
+        if update_rollups:
+            rollup(pgconn)
         pgconn.close()
-        consumer.close()
-
-    except kafka.errors.NoBrokersAvailable:
-        logging.error("Kafka NoBrokersAvailable")
-    except kafka.errors.KafkaError as e:
-        logging.error(f"KafkaError: {e}")
-    except (Exception, psycopg2.Error) as error:
-        logging.error(error)
+    except Exception as error:
+        logging.error(f"Database maintenance error: {error}")
 
 
 @click.command()
 @click.option('--producer', is_flag=True, help='Kafka mode: Producer')
+@click.option('--schedule', is_flag=True,
+              help='Producer: keep checking websites on their intervals')
 @click.option('--consumer', is_flag=True, help='Kafka mode: Consumer')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Consumer: number of worker processes')
+@click.option('--migrate', 'migrate_db', is_flag=True,
+              help='Postgres: apply schema migrations, create partitions')
+@click.option('--rollup', 'update_rollups', is_flag=True,
+              help='Postgres: update rollup tables (run from cron)')
 @click.option('--debug', default=False, is_flag=True, help='Debug mode')
-def main(producer, consumer, debug):
+def main(producer, schedule, consumer, workers, migrate_db, update_rollups,
+         debug):
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
     try:
         topic = settings.kafka_topic
         enabled_web_urls = settings.enabled_web_urls
-        if producer:
+        if producer and schedule:
+            from metrics import start_metrics
+            start_metrics()
+            scheduled_producer(topic, enabled_web_urls)
+
+        elif producer:
             producer = kafka_producer(topic, enabled_web_urls)
 
+        elif consumer and workers > 1:
+            # Kafka Consumer group: one process per worker
+            from consumer import run_workers
+            run_workers(topic, workers)
+
         elif consumer:
             # Kafka Consumer: Read website X status from Kafka topic
             # display it on the screen and send events to the Postgres database
+            from consumer import consume_events
+            from metrics import start_metrics
+            start_metrics()
             consume_events(topic)
 
+        elif migrate_db or update_rollups:
+            maintain_database(update_rollups)
+
     except Exception as e:
         logging.error(e)
 
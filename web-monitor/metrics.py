@@ -0,0 +1,81 @@
+import logging
+import prometheus_client
+from config import settings
+
+PROBE_PHASE_SECONDS = prometheus_client.Histogram(
+    'webmonitor_probe_phase_seconds',
+    'Website check duration by phase',
+    ['phase'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+PROBES = prometheus_client.Counter(
+    'webmonitor_probes_total',
+    'Website checks by result',
+    ['result']
+)
+PRODUCED = prometheus_client.Counter(
+    'webmonitor_produced_messages_total',
+    'Messages sent to Kafka by delivery result',
+    ['result']
+)
+CONSUMED = prometheus_client.Counter(
+    'webmonitor_consumed_events_total',
+    'Events written to Postgres'
+)
+CONSUMER_REJECTED = prometheus_client.Counter(
+    'webmonitor_consumer_rejected_events_total',
+    'Events Postgres rejected, logged and skipped'
+)
+CONSUMER_BATCH_SECONDS = prometheus_client.Histogram(
+    'webmonitor_consumer_batch_seconds',
+    'Time to write one batch of events to Postgres'
+)
+CONSUMER_PENDING_BATCHES = prometheus_client.Gauge(
+    'webmonitor_consumer_pending_batches',
+    'Batches waiting to be written to Postgres'
+)
+CONSUMER_PAUSED = prometheus_client.Gauge(
+    'webmonitor_consumer_paused',
+    '1 while fetching is paused because Postgres is behind'
+)
+SPOOLED = prometheus_client.Counter(
+    'webmonitor_spooled_messages_total',
+    'Messages spooled while Kafka was unreachable, by action',
+    ['action']
+)
+SPOOL_BYTES = prometheus_client.Gauge(
+    'webmonitor_spool_bytes',
+    'Undelivered messages in the spool'
+)
+
+
+def start_metrics(offset=0):
+    """Serve Prometheus metrics on metrics_port + offset
+
+    Nothing is served if metrics_port is not set (0).
+
+    Args:
+        offset (int, optional): Added to metrics_port, e.g. for consumer
+            workers running on the same host. Defaults to 0.
+    """
+    if not settings.metrics_port:
+        return
+    port = settings.metrics_port + offset
+    prometheus_client.start_http_server(port, addr=settings.metrics_addr)
+    logging.info(f"Metrics available on {settings.metrics_addr}:{port}")
+
+
+def observe_probe(status_code, response_time, durations):
+    """Record one website check
+
+    Args:
+        status_code (int): HTTP status code, None if the check failed
+        response_time (float): Seconds until response headers
+        durations (dict): Phase name -> seconds, None if not measured
+    """
+    PROBES.labels('ok' if status_code else 'error').inc()
+    if response_time is not None:
+        PROBE_PHASE_SECONDS.labels('response').observe(response_time)
+    for phase, seconds in durations.items():
+        if seconds is not None:
+            PROBE_PHASE_SECONDS.labels(phase).observe(seconds)
@@ -0,0 +1,321 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import datetime
+import functools
+import logging
+import re
+import ssl
+import time
+import aiohttp
+from yarl import URL
+import metrics
+from config import settings
+
+
+CHUNK_SIZE = 16384
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'download')
+# PhaseTimings of the check running in the current context, the TLS
+# handshake of its connections runs in a copy of the context
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class TimedSSLObject(ssl.SSLObject):
+    """SSLObject that adds the duration of its TLS handshake to the
+    PhaseTimings of the check that opened the connection"""
+    handshake_started = None
+
+    def do_handshake(self):
+        if self.handshake_started is None:
+            self.handshake_started = time.perf_counter()
+        super().do_handshake()
+        timings = _timings.get()
+        if timings is not None:
+            timings.add('tls', time.perf_counter() - self.handshake_started)
+
+
+class PhaseTimings:
+    """Durations of the phases of one website check in seconds
+
+    dns: host name resolution, connect: TCP connect, tls: TLS
+    handshake, ttfb: request sent until response headers received,
+    download: reading the response body. Phases that did not happen
+    (e.g. a reused keep-alive connection) stay None.
+    """
+
+    def __init__(self):
+        self.durations = dict.fromkeys(PHASES)
+        self._started = {}
+
+    def start(self, phase):
+        self._started[phase] = time.perf_counter()
+
+    def end(self, phase):
+        started = self._started.pop(phase, None)
+        if started is not None:
+            self.add(phase, time.perf_counter() - started)
+
+    def add(self, phase, seconds):
+        self.durations[phase] = round(
+            (self.durations[phase] or 0) + max(seconds, 0), 6)
+
+    def end_connect(self):
+        """End the connect phase, DNS resolution and the TLS handshake
+        happen while the connection is created and are not counted
+        twice"""
+        started = self._started.pop('connect', None)
+        if started is not None:
+            dns = self.durations['dns'] or 0
+            tls = self.durations['tls'] or 0
+            self.add('connect', time.perf_counter() - started - dns - tls)
+
+
+def _trace_config():
+    """aiohttp trace config feeding the PhaseTimings passed as
+    trace_request_ctx"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def dns_start(session, context, params):
+        context.trace_request_ctx.start('dns')
+
+    async def dns_end(session, context, params):
+        context.trace_request_ctx.end('dns')
+
+    async def connect_start(session, context, params):
+        context.trace_request_ctx.start('connect')
+
+    async def connect_end(session, context, params):
+        context.trace_request_ctx.end_connect()
+
+    async def headers_sent(session, context, params):
+        context.trace_request_ctx.start('ttfb')
+
+    trace_config.on_dns_resolvehost_start.append(dns_start)
+    trace_config.on_dns_resolvehost_end.append(dns_end)
+    trace_config.on_connection_create_start.append(connect_start)
+    trace_config.on_connection_create_end.append(connect_end)
+    trace_config.on_request_headers_sent.append(headers_sent)
+    return trace_config
+
+
+@functools.lru_cache(maxsize=None)
+def url_patterns(url):
+    """Compiled response body regexes of a website
+
+    Websites listed in web_url_regex use their own list of regexes,
+    all others use web_regex if it is defined.
+
+    Args:
+        url (string): Website URL
+
+    Returns:
+        tuple: Compiled regexes, empty if the body is not checked
+    """
+    overrides = dict(settings.get('web_url_regex') or {})
+    patterns = overrides.get(url)
+    if patterns is None:
+        patterns = settings.get('web_regex')
+    if not patterns:
+        return ()
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return tuple(re.compile(pattern) for pattern in patterns)
+
+
+async def match_body(req, patterns, limit=None, overlap=None):
+    """Match regexes against the response body while it is streamed
+
+    The body is read in chunks and decoded as latin-1. Every chunk is
+    searched together with the last overlap characters of the previous
+    one, so matches up to overlap characters long are found across
+    chunk boundaries. Anchors (^, \\A) and lookbehinds apply to the
+    window, so they can match at a window start inside the body.
+    Reading stops as soon as all regexes matched or after limit bytes.
+
+    Args:
+        req (aiohttp.ClientResponse): Response
+        patterns (tuple): Compiled regexes
+        limit (int, optional): Maximum body bytes to read
+        overlap (int, optional): Characters kept between chunks
+
+    Returns:
+        boolean: All regexes matched
+    """
+    limit = limit or settings.web_body_limit
+    overlap = overlap or settings.web_regex_overlap
+    remaining = list(patterns)
+    tail = ''
+    read = 0
+    async for chunk in req.content.iter_chunked(CHUNK_SIZE):
+        chunk = chunk[:limit - read]
+        read += len(chunk)
+        window = tail + chunk.decode('latin-1')
+        remaining = [p for p in remaining if not p.search(window)]
+        if not remaining or read >= limit:
+            break
+        tail = window[-overlap:]
+    return not remaining
+
+
+async def webchecker(session, url, timings=None):
+    """Check website status for collecting website
+    status code, response time and response body
+
+    Args:
+        session (aiohttp.ClientSession): Shared session with pooled
+            keep-alive connections
+        url (string): Website URL
+        timings (PhaseTimings, optional): Collects phase durations,
+            the session must use the probe trace config
+
+    Returns:
+        status_code (string): HTTP request status code
+        response_time (string): Response time in seconds
+        response_body_regex (boolean): Response body regex match status
+    """
+    timings = timings or PhaseTimings()
+    token = _timings.set(timings)
+    try:
+        start = time.perf_counter()
+        async with session.get(url, trace_request_ctx=timings) as req:
+            # Same meaning as requests' elapsed: time until the
+            # response headers have been received
+            response_time = round(time.perf_counter() - start, 6)
+            timings.end('ttfb')
+            status_code = req.status
+
+            logging.info(f"Website {url} code: {status_code}")
+            logging.info(f"Website {url} response time: {response_time}")
+
+            # Check if response_body matches the expected regexes
+            # defined in settings.yml
+            patterns = url_patterns(url)
+            if not patterns:
+                return status_code, response_time, None
+            timings.start('download')
+            response_body_regex = await match_body(req, patterns)
+            timings.end('download')
+            logging.debug(f"Website {url} regex status: {response_body_regex}")
+            return status_code, response_time, response_body_regex
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Website {url} error: {e!r}")
+        return None, None, None
+    finally:
+        _timings.reset(token)
+
+
+class Prober:
+    """Concurrent website checker
+
+    Keeps one aiohttp session open so connections are pooled and
+    reused (keep-alive) between checks. The number of checks running
+    at once is bounded both globally and per host. A check takes its
+    slots before its request starts, so neither the response time nor
+    the timeout includes time spent waiting for a connection to a busy
+    host.
+
+    Args:
+        concurrency (int): Maximum number of checks running at once
+        limit_per_host (int): Maximum open connections per host
+        timeout (float): Total timeout for a single request in seconds
+        keepalive (float): Seconds an idle connection is kept open
+    """
+
+    def __init__(self, concurrency=None, limit_per_host=None,
+                 timeout=None, keepalive=None):
+        self.concurrency = concurrency or settings.probe_concurrency
+        self.limit_per_host = limit_per_host or settings.probe_limit_per_host
+        self.timeout = timeout or settings.probe_timeout
+        self.keepalive = keepalive or settings.probe_keepalive
+        self.session = None
+        self._semaphore = None
+        self._hosts = None
+
+    async def __aenter__(self):
+        ssl_context = ssl.create_default_context()
+        ssl_context.sslobject_class = TimedSSLObject
+        connector = aiohttp.TCPConnector(
+            ssl=ssl_context,
+            limit=self.concurrency,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive,
+            ttl_dns_cache=300
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=[_trace_config()]
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Same keys and limit as the connections per host of the
+        # connector
+        self._hosts = collections.defaultdict(
+            lambda: asyncio.Semaphore(self.limit_per_host))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def _host_slot(self, url):
+        if not self.limit_per_host:
+            return contextlib.nullcontext()
+        url = URL(url)
+        return self._hosts[url.scheme, url.host, url.port]
+
+    async def check(self, url):
+        """Check one website and build the Kafka message
+
+        Args:
+            url (string): Website URL
+
+        Returns:
+            dict: url, status_code, response_time, response_body_regex,
+                checked_at and <phase>_time for every phase in PHASES
+        """
+        checked_at = datetime.datetime.now(datetime.timezone.utc)
+        timings = PhaseTimings()
+        # Waiting for a host slot holds no global slot
+        async with self._host_slot(url), self._semaphore:
+            status_code, response_time, response_body_regex = \
+                await webchecker(self.session, url, timings)
+        metrics.observe_probe(status_code, response_time, timings.durations)
+        message = {
+            'url': url,
+            'status_code': status_code,
+            'response_time': response_time,
+            'response_body_regex': response_body_regex,
+            'checked_at': checked_at.isoformat()
+        }
+        for phase, seconds in timings.durations.items():
+            message[f'{phase}_time'] = seconds
+        return message
+
+    async def check_all(self, urls):
+        """Check all websites concurrently
+
+        Args:
+            urls (list): list of website URLs
+
+        Returns:
+            list: Kafka messages in the same order as urls
+        """
+        return await asyncio.gather(*(self.check(url) for url in urls))
+
+
+async def _probe_urls(urls):
+    async with Prober() as prober:
+        return await prober.check_all(urls)
+
+
+def probe_urls(urls):
+    """Check all websites concurrently from synchronous code
+
+    Args:
+        urls (list): list of website URLs
+
+    Returns:
+        list: Kafka messages in the same order as urls
+    """
+    return asyncio.run(_probe_urls(urls))
@@ -0,0 +1,235 @@
+import json
+import logging
+import threading
+import time
+import kafka
+import metrics
+from config import settings
+from spool import Spool
+
+
+def create_producer():
+    """Create Kafka producer from settings
+
+    Messages are batched by the producer: a batch is sent when it
+    reaches kafka_batch_size bytes or kafka_linger_ms has passed,
+    optionally compressed with kafka_compression_type.
+
+    Returns:
+        kafka.KafkaProducer: Kafka producer with JSON serializer
+    """
+    return kafka.KafkaProducer(
+        bootstrap_servers=settings.kafka_bootstrap_servers,
+        security_protocol=settings.kafka_security_protocol,
+        ssl_certfile=settings.kafka_ssl_certfile,
+        ssl_keyfile=settings.kafka_ssl_keyfile,
+        ssl_cafile=settings.kafka_ssl_cafile,
+        linger_ms=settings.kafka_linger_ms,
+        batch_size=settings.kafka_batch_size,
+        compression_type=settings.kafka_compression_type or None,
+        value_serializer=lambda m: json.dumps(m).encode('ascii')
+    )
+
+
+def create_spool():
+    """Create the local spool of undelivered messages from settings
+
+    Returns:
+        spool.Spool: Spool in spool_dir
+    """
+    return Spool(settings.spool_dir, settings.spool_segment_bytes,
+                 settings.spool_max_bytes)
+
+
+class DeliveryStats:
+    """Delivery statistics of the messages sent since the last report
+
+    Producer callbacks run in the Kafka sender thread, so counters
+    are guarded by a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new batch"""
+        with self._lock:
+            self.sent = 0
+            self.delivered = 0
+            self.failed = 0
+            self.bytes = 0
+            self.started = time.monotonic()
+
+    def on_sent(self):
+        with self._lock:
+            self.sent += 1
+
+    def on_delivered(self, metadata):
+        with self._lock:
+            self.delivered += 1
+            self.bytes += max(metadata.serialized_value_size, 0)
+        metrics.PRODUCED.labels('delivered').inc()
+
+    def on_failed(self, exc):
+        with self._lock:
+            self.failed += 1
+        metrics.PRODUCED.labels('failed').inc()
+        logging.error(f"Kafka delivery failed: {exc}")
+
+    def report(self):
+        """Log the statistics of the batch and start a new one
+
+        Returns:
+            dict: sent, delivered, failed, bytes, seconds
+        """
+        with self._lock:
+            seconds = time.monotonic() - self.started
+            stats = {
+                'sent': self.sent,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'bytes': self.bytes,
+                'seconds': round(seconds, 3)
+            }
+        rate = stats['delivered'] / seconds if seconds > 0 else 0
+        logging.info(
+            f"Batch delivery: sent {stats['sent']} delivered "
+            f"{stats['delivered']} failed {stats['failed']} "
+            f"bytes {stats['bytes']} in {stats['seconds']}s "
+            f"({rate:.1f} msg/s)")
+        self.reset()
+        return stats
+
+
+def send(producer, topic, message, stats):
+    """Queue a message for the next producer batch
+
+    The message is not flushed, call producer.flush() at the end of a
+    cycle or on shutdown.
+
+    Args:
+        producer (kafka.KafkaProducer): Kafka producer
+        topic (string): Kafka topic name
+        message (dict): Message
+        stats (DeliveryStats): Delivery statistics to update
+
+    Returns:
+        kafka.producer.future.FutureRecordMetadata: Delivery future
+    """
+    future = producer.send(topic, message)
+    stats.on_sent()
+    future.add_callback(stats.on_delivered)
+    future.add_errback(stats.on_failed)
+    return future
+
+
+class Publisher:
+    """Sends messages to Kafka, spooling them while Kafka is unreachable
+
+    A message is appended to the spool instead of being sent while
+    there is no producer (Kafka was unreachable when it was created),
+    while older messages are still spooled, so messages stay in order,
+    and when sending or delivering it fails. replay() connects and
+    sends the spooled messages in order, one batch at a time, and only
+    moves past a batch once all of its messages were delivered, so
+    every message is delivered at least once.
+
+    Args:
+        topic (string): Kafka topic name
+        spool (spool.Spool): Spool of undelivered messages
+        stats (DeliveryStats): Delivery statistics to update
+        replay_batch (int, optional): Messages per replay batch
+        retry_interval (float, optional): Seconds between attempts to
+            reach Kafka
+    """
+
+    def __init__(self, topic, spool, stats, replay_batch=None,
+                 retry_interval=None):
+        self.topic = topic
+        self.spool = spool
+        self.stats = stats
+        self.replay_batch = replay_batch or settings.spool_replay_batch
+        self.retry_interval = (retry_interval
+                               or settings.spool_replay_interval)
+        self.producer = None
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Create the producer, at most every retry_interval seconds
+
+        Returns:
+            boolean: A producer is connected
+        """
+        if self.producer is None and time.monotonic() >= self._retry_at:
+            try:
+                self.producer = create_producer()
+            except kafka.errors.KafkaError as e:
+                logging.error(f"Kafka unreachable, spooling messages: {e!r}")
+                self._retry_at = time.monotonic() + self.retry_interval
+        return self.producer is not None
+
+    def publish(self, message):
+        """Send a message, or spool it
+
+        Args:
+            message (dict): Message
+        """
+        if self.producer is None or not self.spool.empty():
+            self.spool.append([message])
+            return
+        try:
+            future = send(self.producer, self.topic, message, self.stats)
+        except kafka.errors.KafkaError as e:
+            logging.error(f"Kafka send failed, spooling message: {e!r}")
+            self.spool.append([message])
+            return
+        future.add_errback(lambda exc: self.spool.append([message]))
+
+    def replay(self):
+        """Send the spooled messages in order until the spool is empty
+        or a delivery fails
+
+        Returns:
+            int: Number of delivered spooled messages
+        """
+        with self._lock:
+            if time.monotonic() < self._retry_at or not self.connect():
+                return 0
+            replayed = 0
+            while not self.spool.empty():
+                messages, position = self.spool.read(self.replay_batch)
+                failed = []
+                try:
+                    for message in messages:
+                        send(self.producer, self.topic, message,
+                             self.stats).add_errback(failed.append)
+                    self.producer.flush()
+                except kafka.errors.KafkaError as e:
+                    failed.append(e)
+                if failed:
+                    # The batch is sent again by the next replay
+                    logging.error(f"Replay stopped after {replayed} "
+                                  f"messages: {failed[0]!r}")
+                    self._retry_at = time.monotonic() + self.retry_interval
+                    break
+                self.spool.commit(position)
+                replayed += len(messages)
+                metrics.SPOOLED.labels('replayed').inc(len(messages))
+            if replayed:
+                logging.info(f"Replayed {replayed} spooled messages")
+            return replayed
+
+    def flush(self):
+        """Wait for the messages in producer batches, failed ones are
+        spooled"""
+        if self.producer:
+            self.producer.flush()
+
+    def close(self):
+        """Close the producer and the spool, after a running replay"""
+        with self._lock:
+            if self.producer:
+                self.producer.close()
+            self.spool.close()
@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import logging
+import random
+import signal
+from config import settings
+from probe import Prober
+
+
+def url_intervals(urls):
+    """Check interval for every website
+
+    Websites listed in web_url_intervals use their own interval,
+    all others use check_interval.
+
+    Args:
+        urls (list): list of website URLs
+
+    Returns:
+        dict: website URL -> interval in seconds
+    """
+    overrides = dict(settings.get('web_url_intervals') or {})
+    return {url: float(overrides.get(url, settings.check_interval))
+            for url in urls}
+
+
+class Scheduler:
+    """Heap based scheduler that keeps checking websites
+
+    Every website has its own interval. The next check time gets a
+    random jitter so that websites sharing an interval drift apart
+    instead of being checked in bursts. If a website is still being
+    checked when its next check is due, the run is skipped and logged
+    as an overrun.
+
+    Args:
+        prober (probe.Prober): Open probe engine
+        publish (callable): Called with every Kafka message
+        intervals (dict): website URL -> interval in seconds
+        jitter (float): Jitter as a fraction of the interval
+    """
+
+    def __init__(self, prober, publish, intervals, jitter=None):
+        self.prober = prober
+        self.publish = publish
+        self.intervals = intervals
+        self.jitter = settings.check_jitter if jitter is None else jitter
+        self.overruns = 0
+        self._heap = []
+        self._in_flight = {}
+        self._stop = asyncio.Event()
+
+    def _jittered(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def stop(self):
+        """Stop scheduling new checks"""
+        self._stop.set()
+
+    async def _check(self, url):
+        try:
+            message = await self.prober.check(url)
+            self.publish(message)
+        except Exception as e:
+            logging.error(f"Scheduled check error for {url}: {e}")
+        finally:
+            self._in_flight.pop(url, None)
+
+    def _dispatch(self, due, url, now):
+        interval = self.intervals[url]
+        if url in self._in_flight:
+            self.overruns += 1
+            logging.warning(
+                f"Website {url} check overrun: still running after "
+                f"{interval}s interval, skipping this run")
+        else:
+            self._in_flight[url] = asyncio.create_task(self._check(url))
+        # Keep the cadence but never schedule into the past, e.g.
+        # after the host was suspended
+        next_due = max(due + self._jittered(interval), now)
+        heapq.heappush(self._heap, (next_due, url))
+
+    async def run(self):
+        """Check websites until stop() is called"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Spread the first checks over the jitter window
+        for url, interval in self.intervals.items():
+            first = now + random.uniform(0, self.jitter * interval)
+            heapq.heappush(self._heap, (first, url))
+
+        while self._heap and not self._stop.is_set():
+            due = self._heap[0][0]
+            delay = due - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._stop.wait(), delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            now = loop.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, url = heapq.heappop(self._heap)
+                self._dispatch(due, url, now)
+
+        if self._in_flight:
+            logging.info(f"Waiting for {len(self._in_flight)} checks")
+            await asyncio.gather(*list(self._in_flight.values()))
+        logging.info(f"Scheduler stopped, overruns: {self.overruns}")
+
+
+async def _report_every(interval, report):
+    while True:
+        await asyncio.sleep(interval)
+        report()
+
+
+async def _replay_every(interval, replay):
+    while True:
+        # Replaying blocks until Kafka acknowledged, keep checking
+        try:
+            await asyncio.to_thread(replay)
+        except Exception as e:
+            # Replayed again at the next interval, messages keep being
+            # spooled until then
+            logging.error(f"Replaying the spool failed: {e!r}")
+        await asyncio.sleep(interval)
+
+
+async def run_scheduler(urls, publish, report=None, replay=None):
+    """Keep checking websites on their intervals until SIGINT/SIGTERM
+
+    Args:
+        urls (list): list of website URLs
+        publish (callable): Called with every Kafka message
+        report (callable, optional): Called every kafka_stats_interval
+            seconds. Defaults to None.
+        replay (callable, optional): Called in a thread at start and
+            every spool_replay_interval seconds. Defaults to None.
+    """
+    async with Prober() as prober:
+        scheduler = Scheduler(prober, publish, url_intervals(urls))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, scheduler.stop)
+        tasks = []
+        if report:
+            tasks.append(asyncio.create_task(
+                _report_every(settings.kafka_stats_interval, report)))
+        if replay:
+            tasks.append(asyncio.create_task(
+                _replay_every(settings.spool_replay_interval, replay)))
+        await scheduler.run()
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,218 @@
+import datetime
+import logging
+import psycopg2
+from config import settings
+
+# Applied in order, every migration once, see migrate()
+MIGRATIONS = [
+    # 1: time partitioned events table. A plain events table created by
+    # older versions is kept as events_legacy, its rows have no
+    # timestamp and are not copied.
+    """
+    DO $$
+    BEGIN
+        IF (SELECT relkind FROM pg_class
+            WHERE oid = to_regclass('events')) = 'r' THEN
+            ALTER TABLE events RENAME TO events_legacy;
+        END IF;
+    END $$;
+
+    CREATE TABLE events (
+        id BIGSERIAL,
+        url TEXT NOT NULL,
+        status_code INTEGER,
+        response_time REAL,
+        response_body_regex BOOLEAN,
+        checked_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, checked_at)
+    ) PARTITION BY RANGE (checked_at);
+
+    CREATE TABLE events_default PARTITION OF events DEFAULT;
+
+    CREATE INDEX events_url_checked_at_idx ON events (url, checked_at);
+    """,
+    # 2: per URL rollups, see rollup()
+    """
+    CREATE TABLE events_rollup_minute (
+        url TEXT NOT NULL,
+        bucket TIMESTAMPTZ NOT NULL,
+        checks INTEGER NOT NULL,
+        errors INTEGER NOT NULL,
+        min_response_time REAL,
+        avg_response_time REAL,
+        p95_response_time REAL,
+        PRIMARY KEY (url, bucket)
+    );
+
+    CREATE TABLE events_rollup_hour (LIKE events_rollup_minute
+                                     INCLUDING ALL);
+
+    CREATE TABLE rollup_state (
+        name TEXT PRIMARY KEY,
+        last_run TIMESTAMPTZ NOT NULL
+    );
+    """,
+    # 3: per phase timings of a check, see probe.PhaseTimings
+    """
+    ALTER TABLE events
+        ADD COLUMN dns_time REAL,
+        ADD COLUMN connect_time REAL,
+        ADD COLUMN tls_time REAL,
+        ADD COLUMN ttfb_time REAL,
+        ADD COLUMN download_time REAL;
+    """
+]
+
+ROLLUP_SQL = """
+    INSERT INTO {table} AS r (url, bucket, checks, errors,
+                             min_response_time, avg_response_time,
+                             p95_response_time)
+    SELECT url,
+           date_trunc(%(unit)s, checked_at),
+           count(*),
+           count(*) FILTER (WHERE status_code IS NULL
+                            OR status_code >= 400),
+           min(response_time),
+           avg(response_time),
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY response_time)
+    FROM events
+    WHERE checked_at >= date_trunc(%(unit)s, %(since)s::timestamptz)
+    GROUP BY 1, 2
+    ON CONFLICT (url, bucket) DO UPDATE SET
+        checks = EXCLUDED.checks,
+        errors = EXCLUDED.errors,
+        min_response_time = EXCLUDED.min_response_time,
+        avg_response_time = EXCLUDED.avg_response_time,
+        p95_response_time = EXCLUDED.p95_response_time
+"""
+
+
+def connect_postgres():
+    """Connect to Postgres database from settings
+
+    Returns:
+        psycopg2.extensions.connection: Postgres connection
+    """
+    return psycopg2.connect(
+        host=settings.postgres_host,
+        port=settings.postgres_port,
+        user=settings.postgres_user,
+        password=settings.postgres_password,
+        database=settings.postgres_dbname,
+        sslmode=settings.postgres_sslmode,
+        sslrootcert=settings.postgres_ssl_cafile
+    )
+
+
+def migrate(pgconn):
+    """Apply schema migrations that have not been applied yet
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+    """
+    with pgconn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        # Only one process migrates at a time
+        cur.execute("LOCK TABLE schema_migrations IN EXCLUSIVE MODE")
+        cur.execute("SELECT coalesce(max(version), 0) "
+                    "FROM schema_migrations")
+        current = cur.fetchone()[0]
+        for version, sql in enumerate(MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            logging.info(f"Applying schema migration {version}")
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version) "
+                        "VALUES (%s)", (version,))
+    pgconn.commit()
+
+
+def ensure_partitions(pgconn, days_ahead=None):
+    """Create daily events partitions from today to days_ahead
+
+    Rows that already landed in the default partition for a new day
+    are moved into the new partition.
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+        days_ahead (int, optional): Days to create in advance
+    """
+    if days_ahead is None:
+        days_ahead = settings.events_partition_days_ahead
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    with pgconn.cursor() as cur:
+        # Consumers, their workers and --rollup all create partitions,
+        # only one at a time
+        cur.execute("SELECT pg_advisory_xact_lock("
+                    "hashtext('events_partitions'))")
+        for offset in range(days_ahead + 1):
+            start = today + datetime.timedelta(days=offset)
+            end = start + datetime.timedelta(days=1)
+            name = f"events_p{start:%Y%m%d}"
+            cur.execute("SELECT to_regclass(%s)", (name,))
+            if cur.fetchone()[0]:
+                continue
+            logging.info(f"Creating partition {name}")
+            cur.execute(f"CREATE TABLE {name} (LIKE events "
+                        f"INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            bounds = {'start': start, 'end': end}
+            cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM events_default
+                    WHERE checked_at >= %(start)s AND checked_at < %(end)s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+            """, bounds)
+            cur.execute(f"ALTER TABLE events ATTACH PARTITION {name} "
+                        f"FOR VALUES FROM (%(start)s) TO (%(end)s)", bounds)
+    pgconn.commit()
+
+
+def rollup(pgconn):
+    """Update per URL, per minute and per hour rollups incrementally
+
+    Only buckets from the previous run (minus rollup_lag_minutes for
+    late events) onwards are recomputed, the first run builds the
+    rollups from all events.
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+    """
+    with pgconn.cursor() as cur:
+        cur.execute("SELECT last_run FROM rollup_state "
+                    "WHERE name = 'events' FOR UPDATE")
+        row = cur.fetchone()
+        cur.execute("SELECT now()")
+        now = cur.fetchone()[0]
+        if row:
+            lag = datetime.timedelta(minutes=settings.rollup_lag_minutes)
+            since = row[0] - lag
+        else:
+            since = datetime.datetime.min.replace(
+                tzinfo=datetime.timezone.utc)
+        for table, unit in (('events_rollup_minute', 'minute'),
+                            ('events_rollup_hour', 'hour')):
+            cur.execute(ROLLUP_SQL.format(table=table),
+                        {'unit': unit, 'since': since})
+            logging.info(f"Rollup {table}: {cur.rowcount} buckets updated")
+        cur.execute("""
+            INSERT INTO rollup_state (name, last_run) VALUES ('events', %s)
+            ON CONFLICT (name) DO UPDATE SET last_run = EXCLUDED.last_run
+        """, (now,))
+    pgconn.commit()
+
+
+def prepare_database(pgconn):
+    """Apply schema migrations and create upcoming partitions
+
+    Args:
+        pgconn (psycopg2.extensions.connection): Postgres connection
+    """
+    migrate(pgconn)
+    ensure_partitions(pgconn)
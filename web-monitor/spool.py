@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import threading
+import metrics
+
+SEGMENT_SUFFIX = '.jsonl'
+CURSOR_FILE = 'cursor.json'
+
+
+class Spool:
+    """Append-only local spool of Kafka messages
+
+    Messages are appended as JSON lines to segment files of about
+    segment_bytes each, a new segment is started when the current one
+    is full. A persisted cursor (segment and byte offset) marks the
+    messages already delivered, they are read back in order in batches
+    so replaying never holds more than one batch in memory. Delivered
+    segments are deleted.
+
+    At most max_bytes are kept on disk, the oldest segment is dropped
+    when a new one would exceed it.
+
+    Thread safe, messages are appended from the Kafka sender thread
+    when their delivery fails.
+
+    Args:
+        directory (string): Spool directory
+        segment_bytes (int): Segment size in bytes
+        max_bytes (int): Maximum spool size in bytes
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+            and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        self._cursor = self._load_cursor()
+        # Position after the messages of the last read, until committed
+        self._reading = None
+        self._file = None
+        if self._segments:
+            self._repair(self._segments[-1])
+        self._update_metrics()
+
+    def _path(self, segment):
+        return os.path.join(self.directory,
+                            f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                segment, offset = json.load(f)
+        except (OSError, ValueError):
+            segment, offset = 0, 0
+        if not self._segments or segment < self._segments[0]:
+            return self._segments[0] if self._segments else 0, 0
+        return segment, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self._cursor, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _repair(self, segment):
+        """Cut a message torn by a crash off the end of a segment"""
+        path = self._path(segment)
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                logging.warning(f"Spool segment {path}: dropping "
+                                f"{len(data) - end} bytes of a torn message")
+                f.truncate(end)
+
+    def _size(self):
+        size = 0
+        for segment in self._segments:
+            try:
+                size += os.path.getsize(self._path(segment))
+            except OSError:
+                pass
+        if self._segments and self._cursor[0] == self._segments[0]:
+            size -= self._cursor[1]
+        return size
+
+    def _update_metrics(self):
+        metrics.SPOOL_BYTES.set(self._size())
+
+    def _open_segment(self):
+        """Start a new segment, dropping the oldest ones that would not
+        fit into max_bytes"""
+        if self._file:
+            self._file.close()
+        while (len(self._segments) > 0
+               and self._size() + self.segment_bytes > self.max_bytes):
+            oldest = self._segments.pop(0)
+            path = self._path(oldest)
+            with open(path, 'rb') as f:
+                if oldest == self._cursor[0]:
+                    f.seek(self._cursor[1])
+                # Messages being replayed are not counted
+                if self._reading and oldest == self._reading[0]:
+                    f.seek(max(f.tell(), self._reading[1]))
+                dropped = sum(1 for _ in f)
+            os.remove(path)
+            if dropped:
+                metrics.SPOOLED.labels('dropped').inc(dropped)
+                logging.error(f"Spool full, dropped {dropped} messages of "
+                              f"{path}")
+            if oldest == self._cursor[0]:
+                self._cursor = (self._segments[0] if self._segments
+                                else oldest + 1, 0)
+                self._save_cursor()
+        segment = self._segments[-1] + 1 if self._segments else \
+            max(self._cursor[0], 1)
+        if not self._segments:
+            # Nothing undelivered, the cursor moves to the new segment
+            self._cursor = (segment, 0)
+            self._save_cursor()
+        self._segments.append(segment)
+        self._file = open(self._path(segment), 'ab')
+
+    def append(self, messages):
+        """Append messages to the end of the spool
+
+        Args:
+            messages (list): Kafka messages
+        """
+        if not messages:
+            return
+        data = b''.join(json.dumps(message).encode('ascii') + b'\n'
+                        for message in messages)
+        with self._lock:
+            if self._file is None and self._segments:
+                # Continue the last segment of an earlier run
+                self._file = open(self._path(self._segments[-1]), 'ab')
+            if self._file is None or self._file.tell() >= self.segment_bytes:
+                self._open_segment()
+            self._file.write(data)
+            self._file.flush()
+            self._update_metrics()
+        metrics.SPOOLED.labels('spooled').inc(len(messages))
+        logging.warning(f"Spooled {len(messages)} messages")
+
+    def empty(self):
+        """Returns True if all spooled messages were delivered"""
+        with self._lock:
+            return not self._segments or (
+                len(self._segments) == 1
+                and self._cursor[0] == self._segments[0]
+                and self._cursor[1] >= os.path.getsize(
+                    self._path(self._segments[0])))
+
+    def read(self, count):
+        """Read the next undelivered messages
+
+        Args:
+            count (int): Maximum number of messages
+
+        Returns:
+            tuple: list of messages, position to commit once they are
+                delivered
+        """
+        with self._lock:
+            while self._segments:
+                segment, offset = self._cursor
+                if segment not in self._segments:
+                    segment, offset = self._segments[0], 0
+                messages = []
+                with open(self._path(segment), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        offset += len(line)
+                        try:
+                            messages.append(json.loads(line))
+                        except ValueError:
+                            logging.error(f"Skipping invalid spooled "
+                                          f"message: {line[:100]!r}")
+                        if len(messages) >= count:
+                            break
+                if messages or segment == self._segments[-1]:
+                    self._reading = segment, offset
+                    return messages, (segment, offset)
+                # A delivered segment that is not written to anymore
+                self._remove(segment)
+            return [], self._cursor
+
+    def _remove(self, segment):
+        self._segments.remove(segment)
+        os.remove(self._path(segment))
+        self._cursor = (self._segments[0] if self._segments
+                        else segment + 1, 0)
+        self._save_cursor()
+
+    def commit(self, position):
+        """Mark the messages up to position as delivered
+
+        Positions in a segment dropped while the spool was full are
+        ignored, the cursor already moved past it.
+
+        Args:
+            position (tuple): Position returned by read
+        """
+        with self._lock:
+            self._reading = None
+            segment = position[0]
+            if segment not in self._segments:
+                return
+            self._cursor = position
+            if (segment != self._segments[-1]
+                    and position[1] >= os.path.getsize(self._path(segment))):
+                self._remove(segment)
+            else:
+                self._save_cursor()
+            self._update_metrics()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
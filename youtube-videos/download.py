@@ -0,0 +1,189 @@
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+# Bytes requested per range request and read per write
+RANGE_SIZE = 9 * 1024 * 1024
+READ_SIZE = 64 * 1024
+HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RangeIgnoredError(DownloadError):
+    """The server sent more than the requested range"""
+
+
+def read_range(url, start, stop, timeout):
+    """Returns the response for bytes start to stop of a stream URL"""
+    # YouTube stream URLs take the range as a query parameter
+    return urlopen(Request(f"{url}&range={start}-{stop}", headers=HEADERS),
+                   timeout=timeout)
+
+
+def read_part_info(info):
+    """Returns the stream itag and filesize recorded for a .part file,
+    None if there is no readable record"""
+    try:
+        with open(info) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_range(f, r, size, digest, limiter):
+    """Append a range response of size bytes to f
+
+    Args:
+        f (file): .part file, positioned at its end
+        r (http.client.HTTPResponse): Range response
+        size (int): Bytes in the range
+        digest (hashlib.sha256): SHA-256 of the data before the range
+        limiter (BandwidthLimiter): Download rate cap
+
+    Returns:
+        tuple: Bytes received, less than size if the response was
+            short, and the SHA-256 including them
+
+    Raises:
+        RangeIgnoredError: The response is longer than the range,
+            nothing is appended
+    """
+    length = r.headers.get('Content-Length')
+    if length is not None and int(length) > size:
+        raise RangeIgnoredError(f"{length} bytes sent for a {size} bytes "
+                                f"range")
+    start = f.tell()
+    digest = digest.copy()
+    received = 0
+    while received < size:
+        chunk = r.read(min(READ_SIZE, size - received))
+        if not chunk:
+            break
+        f.write(chunk)
+        digest.update(chunk)
+        received += len(chunk)
+        limiter.consume(len(chunk))
+    else:
+        if r.read(1):
+            f.truncate(start)
+            f.seek(start)
+            raise RangeIgnoredError(f"More than {size} bytes sent for a "
+                                    f"{size} bytes range")
+    return received, digest
+
+
+def download_stream(stream, output_path, limiter, max_retries=5,
+                    timeout=30):
+    """Download a pytube stream with resumable range requests
+
+    Data is appended to <file>.part, a later call continues from its
+    last written byte. The stream itag and filesize are recorded in
+    <file>.part.json, a .part file of another stream is discarded.
+    The file is renamed to its final name only after its size matches
+    the stream and its SHA-256 matches the received data. Failed, empty
+    or short responses are retried from the current offset with
+    exponential backoff, a response longer than its range is rejected.
+
+    Args:
+        stream (pytube.Stream): Video stream
+        output_path (string): Directory of the video file
+        limiter (BandwidthLimiter): Download rate cap
+        max_retries (int, optional): Retries of a failed request.
+            Defaults to 5.
+        timeout (int, optional): Request timeout in seconds.
+            Defaults to 30.
+
+    Returns:
+        tuple: Video file name and its SHA-256 (None if the file
+            already existed)
+    """
+    file = stream.get_file_path(output_path=output_path)
+    if stream.exists_at_path(file):
+        logging.info(f"File exists, skipping: {file}")
+        return file, None
+    part = f"{file}.part"
+    info = f"{part}.json"
+    total = stream.filesize
+    stream_info = {'itag': stream.itag, 'filesize': total}
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part):
+        if read_part_info(info) != stream_info:
+            logging.warning(f"Discarding {part} of another stream")
+        else:
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+            if offset > total:
+                logging.warning(f"Discarding oversized {part}")
+                digest = hashlib.sha256()
+                offset = 0
+            else:
+                logging.info(f"Resuming {file} at {offset}/{total} bytes")
+    if not offset:
+        with open(info, 'w') as f:
+            json.dump(stream_info, f)
+    tries = 0
+    with open(part, 'r+b' if offset else 'wb') as f:
+        f.truncate(offset)
+        f.seek(offset)
+        while offset < total:
+            stop = min(offset + RANGE_SIZE, total) - 1
+            size = stop - offset + 1
+            try:
+                with read_range(stream.url, offset, stop, timeout) as r:
+                    received, digest = write_range(f, r, size, digest,
+                                                   limiter)
+                offset += received
+                if received == size:
+                    tries = 0
+                    continue
+                error = f"short response, {received} of {size} bytes"
+            except (URLError, socket.timeout, http.client.HTTPException,
+                    ConnectionError) as e:
+                if (isinstance(e, HTTPError) and e.code < 500
+                        and e.code != 429):
+                    raise
+                error = e
+                # Drop the data of the failed response, it is requested
+                # again
+                f.truncate(offset)
+                f.seek(offset)
+            tries += 1
+            if tries > max_retries:
+                raise DownloadError(f"{file}: {error}, {offset}/{total} "
+                                    f"bytes kept in {part}")
+            wait = min(2 ** tries, 60) * random.uniform(0.5, 1)
+            logging.warning(f"Download error at {offset}/{total} bytes "
+                            f"of {file}: {error}, retry {tries} in "
+                            f"{wait:.1f}s")
+            f.flush()
+            time.sleep(wait)
+        f.flush()
+        os.fsync(f.fileno())
+    size = os.path.getsize(part)
+    if size != total:
+        raise DownloadError(f"{part}: size {size} does not match {total}")
+    sha256 = digest.hexdigest()
+    with open(part, 'rb') as f:
+        written = hashlib.sha256()
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            written.update(chunk)
+    if written.hexdigest() != sha256:
+        os.remove(part)
+        os.remove(info)
+        raise DownloadError(f"{part}: SHA-256 does not match received data")
+    os.replace(part, file)
+    os.remove(info)
+    return file, sha256
@@ -2,101 +2,201 @@
 from pytube import Channel
 from pytube import YouTube
 from pytube import exceptions
+from pytube import extract
 import os
 import logging
 import click
-from time import sleep
-from multiprocessing import current_process
-from multiprocessing import cpu_count
-from multiprocessing import get_context
-import deepdiff
+import collections
+import random
+import threading
+import time
+from concurrent import futures
 import sys
+from download import download_stream
+from videoindex import VideoIndex
 
+# A video whose metadata was fetched, ready for download
+Video = collections.namedtuple('Video', ['url', 'yt', 'stream',
+                                         'publish_dir'])
 
-def get_video(url, resolution, vid_dir):
-    """Downloads a video from a given YouTube URL
-    and adds it to the current directory <vid_dir>.
+
+class BandwidthLimiter:
+    """Total download rate cap shared by all download threads
+
+    Every downloaded chunk books its transfer time at the capped rate,
+    a download that gets ahead of its booking sleeps until it is due.
+
+    Args:
+        rate (float): Maximum bytes per second, 0 for unlimited
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes):
+        """Account for nbytes downloaded, blocks while over the cap"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + nbytes / self.rate
+            wait = self._next - now
+        time.sleep(wait)
+
+
+def get_metadata(url, resolution, vid_dir):
+    """Fetch the metadata and stream details of a YouTube video
 
     Args:
         url (string): YouTube video URL
+        resolution (string): 'high' or 'low'
+        vid_dir (string): Video directory location
+
+    Returns:
+        Video: Video ready for download, None on errors
     """
     try:
         yt = YouTube(url)
-        # get the current process
-        process = current_process()
-        logging.info(f'Worker is {process.name} with {yt.title} {url}')
-        # block for a moment
-        sleep(1)
+        logging.info(f'Worker is {threading.current_thread().name} '
+                     f'with {yt.title} {url}')
         date = yt.publish_date.astimezone().strftime('%Y-%m-%d')
         # Define directory location
         publish_dir = os.path.join(vid_dir, date)
         logging.info(
             f"Video Title: {yt.title}|Date: {date}|Saving to: {publish_dir}")
-        if not os.path.exists(publish_dir):
-            logging.info(f"Creating directory: {publish_dir}")
-            os.makedirs(publish_dir)
-        # Get current file list in directory
-        current_files = get_files(publish_dir)
-
-        # Download the video
         if resolution == 'high':
-            yt.streams.get_highest_resolution().download(
-                output_path=publish_dir, max_retries=5)
-            # Get current (new) file list in directory
-            new_files = get_files(publish_dir)
-
+            stream = yt.streams.get_highest_resolution()
         elif resolution == 'low':
-            yt.streams.get_lowest_resolution().download(
-                output_path=publish_dir, max_retries=5)
-            new_files = get_files(publish_dir)
-
-        # Report new video filenames
-        diff = deepdiff.DeepDiff(current_files, new_files)
-        fileitems = diff.get('iterable_item_added')
-        if fileitems:
-            for h in fileitems.items():
-                print(f"New video added: {h[1]}")
-                logging.info(f"New video added: {h[1]}")
+            stream = yt.streams.get_lowest_resolution()
+        return Video(url, yt, stream, publish_dir)
 
     except exceptions.VideoUnavailable as e:
         logging.error(f'Video is unavailable: {e}')
     except exceptions.PytubeError as e:
         logging.error(f'Pytube error: {e}')
     except Exception as e:
-        logging.error(f'Error in get_video - Title: {yt.title} - Error: {e}')
+        logging.error(f'Error in get_metadata - URL: {url} - Error: {e}')
+    return None
 
 
-def get_files(publish_dir):
-    """Get full filenames with directory location
+def get_video(video, index, limiter):
+    """Downloads a video to its publish date directory
+    under <vid_dir> and records it in the index.
 
     Args:
-        publish_dir (list): Video directory location
+        video (Video): Video from get_metadata
+        index (VideoIndex): Downloaded video index
+        limiter (BandwidthLimiter): Download rate cap
 
     Returns:
-        list: full file name with path location
+        string: Video file name, None on errors
     """
     try:
-        filelist = os.listdir(publish_dir)
-        curfilelist = []
-        for file in filelist:
-            fileloc = publish_dir + "/" + file
-            file_exists = os.path.exists(fileloc)
-            if file_exists:
-                curfilelist.append(fileloc)
-        return curfilelist
+        logging.info(f'Worker is {threading.current_thread().name} '
+                     f'downloading {video.yt.title}')
+        publish_dir = video.publish_dir
+        if not os.path.exists(publish_dir):
+            logging.info(f"Creating directory: {publish_dir}")
+            os.makedirs(publish_dir, exist_ok=True)
+        # Download the video, an existing file of the same size is kept
+        file, sha256 = download_stream(video.stream, publish_dir, limiter)
+        index.add(video.yt.video_id, video.url, video.yt.title, file,
+                  sha256)
+        # No SHA-256 if the file was already on disk
+        if sha256 is None:
+            logging.info(f"Video already present: {file}")
+        else:
+            print(f"New video added: {file}")
+            logging.info(f"New video added: {file}")
+        return file
 
+    except exceptions.PytubeError as e:
+        logging.error(f'Pytube error: {e}')
     except Exception as e:
-        logging.error(f'Get_files Error: {e}')
+        logging.error(f'Error in get_video - Title: {video.yt.title} '
+                      f'- Error: {e}')
+    return None
+
+
+def download_videos(urls, resolution, vid_dir, index, metadata_workers,
+                    download_workers, bandwidth=0):
+    """Download videos with separate limits for metadata fetches and
+    downloads
+
+    Videos already in the index are skipped before any network call.
 
+    Metadata of up to metadata_workers videos is fetched concurrently,
+    every video with metadata is handed to up to download_workers
+    download threads sharing the bandwidth cap. Results are collected
+    as each download finishes. Metadata is only fetched a few videos
+    ahead of the downloads.
 
-def get_channel(url):
+    Args:
+        urls (iterable): YouTube video URLs
+        resolution (string): 'high' or 'low'
+        vid_dir (string): Video directory location
+        index (VideoIndex): Downloaded video index
+        metadata_workers (int): Concurrent metadata fetches
+        download_workers (int): Concurrent downloads
+        bandwidth (float, optional): Maximum total bytes per second,
+            0 for unlimited. Defaults to 0.
+
+    Returns:
+        int: Number of downloaded videos
+    """
+    limiter = BandwidthLimiter(bandwidth)
+    urls = iter(urls)
+    skipped = 0
+    ahead = metadata_workers + 2 * download_workers
+    completed = 0
+    pending = set()
+    with futures.ThreadPoolExecutor(
+            metadata_workers, thread_name_prefix='metadata') as metadata, \
+            futures.ThreadPoolExecutor(
+                download_workers, thread_name_prefix='download') as downloads:
+        while True:
+            while len(pending) < ahead:
+                url = next(urls, None)
+                if url is None:
+                    break
+                if index.downloaded(extract.video_id(url)):
+                    logging.debug(f"Already downloaded: {url}")
+                    skipped += 1
+                    continue
+                pending.add(metadata.submit(get_metadata, url, resolution,
+                                            vid_dir))
+            if not pending:
+                break
+            done, pending = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if isinstance(result, Video):
+                    pending.add(downloads.submit(get_video, result, index,
+                                                 limiter))
+                elif result is not None:
+                    completed += 1
+    logging.info(f"Skipped {skipped} videos already downloaded")
+    return completed
+
+
+def get_channel(url, index, last=None):
     """Get list of YouTube video urls from a YouTube channel
 
+    The channel listing is cached in the index. Channel pages are only
+    fetched until a cached video is reached, or until the last newest
+    videos were found.
+
     Args:
         url (string): YouTube channel URL
+        index (VideoIndex): Index with the cached channel listing
+        last (int, optional): Only the newest last videos.
+            Defaults to None.
 
     Returns:
-        list: Return list of video URLs
+        list: Return list of video URLs, newest first
     """
     try:
         c = Channel(url)
@@ -104,7 +204,29 @@ def get_channel(url):
         if not c:
             logging.error(f"Error: No response from the channel: {c}")
             return None
-        return c.video_urls
+        cached, complete = index.channel(url)
+        # Without a complete cached listing page through all videos
+        known = set(cached) if complete else set()
+        new_ids = []
+        for video_url in c.url_generator():
+            video_id = extract.video_id(video_url)
+            if video_id in known:
+                break
+            new_ids.append(video_id)
+            if last and len(new_ids) >= last:
+                # Videos between these and the cached ones are unknown
+                complete = False
+                break
+        else:
+            complete = True
+        logging.info(f"New videos in channel listing: {len(new_ids)}, "
+                     f"cached: {len(cached)}")
+        index.update_channel(url, new_ids, complete)
+        new = set(new_ids)
+        video_ids = new_ids + [video_id for video_id in cached
+                               if video_id not in new]
+        return [f"https://www.youtube.com/watch?v={video_id}"
+                for video_id in video_ids[:last]]
 
     except exceptions.PytubeError as e:
         logging.error(f'Pytube error: {e}')
@@ -118,7 +240,8 @@ def getlogger():
     """Logging details
     """
     logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        format='%(asctime)s - %(threadName)s - '
+                               '%(levelname)s - %(message)s',
                         filename='main.log')
 
 
@@ -128,14 +251,28 @@ def getlogger():
               type=click.Choice(['low', 'high'], case_sensitive=False))
 @click.option('--vid_dir', help='Video <directory> location', default='/')
 @click.option('--last', help='Number of last videos to download', type=int)
-def main(url, resolution, vid_dir, last):
+@click.option('--metadata_workers', help='Concurrent metadata fetches',
+              type=int, default=4)
+@click.option('--download_workers', help='Concurrent downloads', type=int,
+              default=2)
+@click.option('--bandwidth', help='Max total download rate in MB/s, '
+              '0 for unlimited', type=float, default=0)
+@click.option('--index', 'index_file', help='Downloaded video index file, '
+              'defaults to <vid_dir>/videos.sqlite')
+@click.option('--retries', help='Retries of the channel listing', type=int,
+              default=5)
+def main(url, resolution, vid_dir, last, metadata_workers, download_workers,
+         bandwidth, index_file, retries):
     """Main function"""
     getlogger()
     # Show Python version
     logging.info(f"Python version: {sys.version}")
     try:
+        os.makedirs(vid_dir, exist_ok=True)
+        index = VideoIndex(index_file or os.path.join(vid_dir,
+                                                      'videos.sqlite'))
         # Get video URLs from a YouTube channel
-        yt_url = get_channel(url)
+        yt_url = get_channel(url, index, last)
         # Add retry logic if no videos are found
         # due to mysterious "onResponseReceivedActions" error
         # TODO: troubleshoot "onResponseReceivedActions" log output
@@ -143,16 +280,19 @@ def main(url, resolution, vid_dir, last):
         count = 0
         while yt_url is None:
             count += 1
-            logging.info(f"Retry {count}: url is None. Retrying...")
-            yt_url = get_channel(url)
-            if yt_url is not None:
-                break
+            if count > retries:
+                logging.error(f"No videos after {retries} retries")
+                index.close()
+                return
+            wait = min(2 ** count, 60) * random.uniform(0.5, 1)
+            logging.info(f"Retry {count}/{retries}: url is None. "
+                         f"Retrying in {wait:.1f}s...")
+            time.sleep(wait)
+            yt_url = get_channel(url, index, last)
 
         total_videos = len(yt_url)
         logging.info(f"Total videos: {total_videos}")
         # Download YouTube videos defined in the channel
-        ctx = get_context('spawn')
-        pool = ctx.Pool(cpu_count(), initializer=getlogger)
         if last:
             latest = []
             # If total_videos is less than last, then override last
@@ -161,22 +301,19 @@ def main(url, resolution, vid_dir, last):
             for url in range(last):
                 video = yt_url[url]
                 latest.append(video)
-            processes = [pool.apply_async(get_video, args=(
-                url, resolution, vid_dir)) for url in latest]
-            result = [p.get() for p in processes]
-            print(f"Completed download of last {len(result)} videos")
-            logging.info(f"Completed download of last {len(result)} videos")
-            pool.close()
-            pool.join()
+            result = download_videos(latest, resolution, vid_dir, index,
+                                     metadata_workers, download_workers,
+                                     bandwidth * 1024 * 1024)
+            print(f"Completed download of last {result} videos")
+            logging.info(f"Completed download of last {result} videos")
 
         else:
-            processes = [pool.apply_async(get_video, args=(
-                url, resolution, vid_dir)) for url in yt_url]
-            result = [p.get() for p in processes]
-            print(f"Completed download of {len(result)} videos")
-            logging.info(f"Completed download of {len(result)} videos")
-            pool.close()
-            pool.join()
+            result = download_videos(yt_url, resolution, vid_dir, index,
+                                     metadata_workers, download_workers,
+                                     bandwidth * 1024 * 1024)
+            print(f"Completed download of {result} videos")
+            logging.info(f"Completed download of {result} videos")
+        index.close()
 
     except Exception as e:
         logging.error(f"Main function error: {e}")
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """Returns the SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class VideoIndex:
+    """On-disk index of downloaded videos and channel listings
+
+    Stores the file, size and SHA-256 of every downloaded video by
+    video ID, so later runs skip them without any network call, and
+    the video IDs of every listed channel, so later runs only page
+    through videos published since. Shared by all download threads.
+
+    Args:
+        path (string): SQLite database file
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY,
+                    url TEXT,
+                    title TEXT,
+                    file TEXT,
+                    size INTEGER,
+                    sha256 TEXT,
+                    downloaded_at REAL
+                )
+            """)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS channels (
+                    url TEXT PRIMARY KEY,
+                    complete INTEGER,
+                    listed_at REAL
+                )
+            """)
+            # seq grows with the publish order, newest video has the
+            # highest seq
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS channel_videos (
+                    channel TEXT,
+                    video_id TEXT,
+                    seq INTEGER,
+                    PRIMARY KEY (channel, video_id)
+                )
+            """)
+
+    def downloaded(self, video_id):
+        """Returns True if the video was downloaded and its file still
+        has the recorded size"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file, size FROM videos WHERE video_id = ?",
+                (video_id,)).fetchone()
+        if not row:
+            return False
+        try:
+            return os.path.getsize(row[0]) == row[1]
+        except OSError:
+            return False
+
+    def add(self, video_id, url, title, file, sha256=None):
+        """Record a downloaded video, its size and, if not given, its
+        SHA-256 are read from file
+
+        Args:
+            video_id (string): YouTube video ID
+            url (string): YouTube video URL
+            title (string): Video title
+            file (string): Video file location
+            sha256 (string, optional): SHA-256 of the file
+        """
+        size = os.path.getsize(file)
+        sha256 = sha256 or file_sha256(file)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (video_id, url, title, file, size, sha256, time.time()))
+
+    def channel(self, url):
+        """Returns the cached video IDs of a channel, newest first, and
+        whether the cached listing reaches the oldest video
+
+        Args:
+            url (string): YouTube channel URL
+
+        Returns:
+            tuple: list of video IDs, boolean
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT complete FROM channels WHERE url = ?",
+                (url,)).fetchone()
+            ids = [video_id for video_id, in self.db.execute(
+                "SELECT video_id FROM channel_videos WHERE channel = ? "
+                "ORDER BY seq DESC", (url,))]
+        return ids, bool(row and row[0])
+
+    def update_channel(self, url, new_ids, complete):
+        """Add the videos published since the cached listing
+
+        Args:
+            url (string): YouTube channel URL
+            new_ids (list): Video IDs newer than the cached ones,
+                newest first
+            complete (boolean): The cached listing continues without
+                gap after new_ids down to the oldest video
+        """
+        with self.lock, self.db:
+            top = self.db.execute(
+                "SELECT coalesce(max(seq), 0) FROM channel_videos "
+                "WHERE channel = ?", (url,)).fetchone()[0]
+            self.db.executemany(
+                "INSERT OR REPLACE INTO channel_videos VALUES (?, ?, ?)",
+                [(url, video_id, top + len(new_ids) - i)
+                 for i, video_id in enumerate(new_ids)])
+            self.db.execute(
+                "INSERT OR REPLACE INTO channels VALUES (?, ?, ?)",
+                (url, int(complete), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()